@@ -6,35 +6,85 @@ import threading
 import traceback
 import sqlite3
 import json
+import hashlib
+import http.client
 import os
+import sys
+import queue
+import socket
+import struct
+import uuid
+import signal
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import datetime
-import webbrowser
+import time
+import random
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 from phue import Bridge
-import pyatv
-from pyatv.const import DeviceState
-from pyatv.interface import PushListener
-
-# For system tray
-import pystray
-from pystray import MenuItem as item
-from PIL import Image  # For tray icon image (pystray requires Pillow)
+# pyatv (slow to import) is imported where it is first used, on the event
+# loop. The tray stack (pystray, Pillow, webbrowser) is only imported in tray
+# mode, so headless servers start faster and need no display.
 
 ###############################################################################
-# LOAD CONFIG (HOST & PORT)
+# LOAD CONFIG
 ###############################################################################
 CONFIG_FILE = "config.json"
 
+conf = {}
 if os.path.exists(CONFIG_FILE):
     with open(CONFIG_FILE) as f:
         conf = json.load(f)
-    HOST = conf.get("host", "127.0.0.1")
-    PORT = int(conf.get("port", 8888))
-else:
-    HOST = "127.0.0.1"
-    PORT = 8888
+HOST = conf.get("host", "127.0.0.1")
+PORT = int(conf.get("port", 8888))
+# Run without the tray icon (also `python app.py --headless`), e.g. on a Linux server
+HEADLESS = bool(conf.get("headless", False)) or "--headless" in sys.argv
+# HTTP server: "waitress" (falls back to "dev" if not installed) or "dev" (Werkzeug).
+# Always one process: the Apple TV monitors and Hue queues live in this process'
+# event loop, so requests are served by a thread pool instead of worker processes.
+SERVER = conf.get("server", "waitress")
+SERVER_THREADS = int(conf.get("server_threads", 16))
+SERVER_CONNECTION_LIMIT = int(conf.get("server_connection_limit", 100))
+# Seconds an idle keep-alive connection is kept open
+SERVER_CHANNEL_TIMEOUT = int(conf.get("server_channel_timeout", 120))
+# Open log/status streams each hold a server thread; cap them below server_threads
+# so plain API requests always have threads left
+MAX_STREAM_CLIENTS = max(1, min(int(conf.get("max_stream_clients", SERVER_THREADS // 2)),
+                                SERVER_THREADS - 1))
+# Threads sending Hue commands, and keep-alive connections, per bridge (rooms run
+# in parallel, each room in order)
+HUE_WORKERS = int(conf.get("hue_workers", 4))
+# Requests per second each bridge is sent (token bucket; 0 = unlimited)
+BRIDGE_RATE = float(conf.get("bridge_rate", 10))
+BRIDGE_BURST = int(conf.get("bridge_burst", 10))
+# Entertainment streaming for rooms with a stream_area: "dtls" (real bridges,
+# needs python-mbedtls) or "udp" (plain frames, for local stand-ins)
+STREAM_TRANSPORT = conf.get("stream_transport", "dtls")
+STREAM_PORT = int(conf.get("stream_port", 2100))
+STREAM_FPS = float(conf.get("stream_fps", 25))
+# Apple TV pairing: max seconds per step, and how long idle sessions/results live
+PAIRING_TIMEOUT_SEC = float(conf.get("pairing_timeout_sec", 30))
+PAIRING_TTL_SEC = float(conf.get("pairing_ttl_sec", 300))
+# Colour temperature (mireds) rooms return to outside their profile's ct periods;
+# 366 (~2700 K) is what Hue white lights power on at
+PROFILE_DEFAULT_CT = int(conf.get("default_ct", 366))
+# Quiet period before a room's latest play-state target is sent (0 = off)
+SETTLE_SEC = float(conf.get("settle_ms", 250)) / 1000
+# How often each bridge's light inventory/states are re-read (0 = on demand only)
+LIGHT_REFRESH_SEC = float(conf.get("light_refresh_sec", 60))
+# How long a discovered Apple TV config is reused before rescanning its host
+SCAN_CACHE_SEC = float(conf.get("scan_cache_sec", 300))
+# Apple TV reconnect backoff bounds (doubles per failed attempt, with jitter)
+RECONNECT_MIN_SEC = float(conf.get("reconnect_min_sec", 2))
+RECONNECT_MAX_SEC = float(conf.get("reconnect_max_sec", 300))
+# Log records kept in memory for /api/logs, and an optional file to append to
+LOG_BUFFER_SIZE = int(conf.get("log_buffer", 1000))
+LOG_FILE = conf.get("log_file")
+# Play-state / light history: kept in its own DB file, purged after history_days
+HISTORY_DB_PATH = conf.get("history_db", "rnr_history.db")
+HISTORY_RETENTION_DAYS = float(conf.get("history_days", 90))
 
 ###############################################################################
 # OTHER CONSTANTS
@@ -53,169 +103,1024 @@ loop = asyncio.new_event_loop()
 app = Flask(__name__)
 
 ###############################################################################
-# REAL-TIME LOG BUFFER
+# SEQUENCED EVENT BUFFERS (shared by the log and status streams)
 ###############################################################################
-server_logs = deque(maxlen=300)
+class EventBuffer:
+    """Bounded buffer of (seq, item); seq increases by 1 per item.
+
+    Readers either fetch what is newer than a seq they already have, or
+    block in stream() until something new arrives.
+    """
+
+    def __init__(self, maxlen):
+        self.entries = deque(maxlen=maxlen)
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def append(self, item):
+        with self.cond:
+            self.seq += 1
+            self.entries.append((self.seq, item))
+            self.cond.notify_all()
+            return self.seq
+
+    def since(self, since):
+        """Return (latest_seq, [(seq, item), ...] newer than `since`)."""
+        with self.cond:
+            if since > self.seq:
+                since = 0   # seq from before a restart
+            out = []
+            for entry in reversed(self.entries):
+                if entry[0] <= since:
+                    break
+                out.append(entry)
+            out.reverse()
+            return self.seq, out
+
+    def stream(self, since, keepalive=15):
+        """Yield batches of newer entries forever ([] after `keepalive` idle seconds)."""
+        last = since or 0
+        while True:
+            with self.cond:
+                if last > self.seq:
+                    last = 0
+                self.cond.wait_for(lambda: self.seq > last, timeout=keepalive)
+            _, entries = self.since(last)
+            if entries:
+                last = entries[-1][0]
+            yield entries
+
+stream_clients = 0
+stream_clients_lock = threading.Lock()
+
+def _release_stream_client():
+    global stream_clients
+    with stream_clients_lock:
+        stream_clients -= 1
+
+def sse_response(buf, format_item, keep=None):
+    """Serve `buf` as Server-Sent Events, resuming from ?since= or Last-Event-ID.
+
+    `keep(item)`, if given, filters which entries are sent. Beyond
+    MAX_STREAM_CLIENTS open streams the client gets a 503 and should poll.
+    """
+    global stream_clients
+    since = request.args.get("since", type=int)
+    if since is None:
+        since = request.headers.get("Last-Event-ID", type=int)
+
+    with stream_clients_lock:
+        if stream_clients >= MAX_STREAM_CLIENTS:
+            return Response("retry: 30000\n\n", status=503, mimetype="text/event-stream",
+                            headers={"Retry-After": "30", "Cache-Control": "no-cache"})
+        stream_clients += 1
+    # waitress (with channel_request_lookahead) notices closed tabs before our next write
+    disconnected = request.environ.get("waitress.client_disconnected")
+
+    def gen():
+        # Sent at once so the client gets the headers without waiting for an event
+        yield ": connected\n\n"
+        for entries in buf.stream(since):
+            if disconnected is not None and disconnected():
+                return
+            if not entries:
+                yield ": keepalive\n\n"
+                continue
+            chunks = []
+            for seq, item in entries:
+                if keep is not None and not keep(item):
+                    continue
+                data = "".join(f"data: {part}\n" for part in format_item(item).split("\n"))
+                chunks.append(f"id: {seq}\n{data}\n")
+            if chunks:
+                yield "".join(chunks)
+
+    resp = Response(gen(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Runs when the server closes the response, also if gen() never started
+    resp.call_on_close(_release_stream_client)
+    return resp
 
-def append_log(msg: str):
-    """Add a timestamped line to our in-memory log buffer and print to console."""
-    now_str = datetime.datetime.now().strftime("%H:%M:%S")
-    line = f"[{now_str}] {msg}"
-    server_logs.append(line)
-    print(line)
+###############################################################################
+# REAL-TIME LOG BUFFER
+###############################################################################
+# Each entry is a compact record tuple; nothing is formatted on the hot path.
+# `msg` is a str.format template that is only filled in when someone reads it
+# (API, stream, or the console/file writer thread).
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+LOG_TS, LOG_LEVEL, LOG_CATEGORY, LOG_ATV, LOG_ROOM, LOG_MSG, LOG_FIELDS = range(7)
+
+server_logs = EventBuffer(LOG_BUFFER_SIZE)
+log_output = queue.SimpleQueue()
+
+def append_log(msg: str, level="INFO", category="app", atv_id=None, room=None, **fields):
+    """Record a log event; `msg` may reference atv_id, room and **fields as {name}."""
+    rec = (time.time(), level, category, atv_id, room, msg, fields)
+    server_logs.append(rec)
+    log_output.put(rec)
+
+def format_log(rec):
+    """Render a record as the classic '[HH:MM:SS] [LEVEL] message' line."""
+    try:
+        text = rec[LOG_MSG].format(atv_id=rec[LOG_ATV], room=rec[LOG_ROOM], **rec[LOG_FIELDS])
+    except (KeyError, IndexError, ValueError):
+        text = f"{rec[LOG_MSG]} {rec[LOG_FIELDS]}"
+    ts = datetime.datetime.fromtimestamp(rec[LOG_TS]).strftime("%H:%M:%S")
+    if rec[LOG_LEVEL] == "INFO":
+        return f"[{ts}] {text}"
+    return f"[{ts}] [{rec[LOG_LEVEL]}] {text}"
+
+def log_record_json(rec):
+    return {
+        "ts":       rec[LOG_TS],
+        "level":    rec[LOG_LEVEL],
+        "category": rec[LOG_CATEGORY],
+        "atv_id":   rec[LOG_ATV],
+        "room":     rec[LOG_ROOM],
+        "message":  format_log(rec),
+        "fields":   {k: v if isinstance(v, (int, float, str, bool, list, type(None))) else str(v)
+                     for k, v in rec[LOG_FIELDS].items()}
+    }
+
+def _log_writer():
+    """Console/file output, off the caller's thread."""
+    out = open(LOG_FILE, "a", encoding="utf-8") if LOG_FILE else None
+    while True:
+        batch = [log_output.get()]
+        while True:
+            try:
+                batch.append(log_output.get_nowait())
+            except queue.Empty:
+                break
+        # flush_logs() waiters are set once everything queued before them is written
+        waiters = [rec for rec in batch if isinstance(rec, threading.Event)]
+        if waiters:
+            batch = [rec for rec in batch if not isinstance(rec, threading.Event)]
+        text = "\n".join(format_log(rec) for rec in batch) + "\n" if batch else ""
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except Exception:
+            pass    # e.g. pythonw has no console
+        if out is not None:
+            out.write(text)
+            out.flush()
+        for done in waiters:
+            done.set()
+
+threading.Thread(target=_log_writer, name="log-writer", daemon=True).start()
+
+def flush_logs(timeout=2):
+    """Wait until the records logged so far reach the console/log file."""
+    done = threading.Event()
+    log_output.put(done)
+    done.wait(timeout)
+
+def log_filter_from_args(args):
+    """Build a record predicate from ?level= (minimum), ?category=, ?room=, ?atv_id=."""
+    min_level = LOG_LEVELS.get((args.get("level") or "").upper(), 0)
+    category = args.get("category")
+    room = args.get("room")
+    atv_id = args.get("atv_id")
+    if not (min_level or category or room or atv_id):
+        return None
+
+    def keep(rec):
+        return (LOG_LEVELS.get(rec[LOG_LEVEL], 0) >= min_level
+                and (category is None or rec[LOG_CATEGORY] == category)
+                and (room is None or rec[LOG_ROOM] == room)
+                and (atv_id is None or rec[LOG_ATV] == atv_id))
+    return keep
 
 @app.route("/api/logs", methods=["GET"])
 def get_logs():
-    """Return all logs as a JSON list of strings."""
-    return jsonify(list(server_logs))
+    """Return all logs as a JSON list of strings.
+
+    With ?since=<seq>, return only newer lines as {"seq": latest, "lines": [...]}.
+    Filters: ?level=WARN (minimum level), ?category=, ?room=, ?atv_id=.
+    ?format=json returns structured records instead of strings.
+    """
+    keep = log_filter_from_args(request.args)
+    render = log_record_json if request.args.get("format") == "json" else format_log
+    since = request.args.get("since", type=int)
+    latest, entries = server_logs.since(since or 0)
+    lines = [render(rec) for _, rec in entries if keep is None or keep(rec)]
+    if since is None:
+        return jsonify(lines)
+    return jsonify({"seq": latest, "lines": lines})
+
+@app.route("/api/logs/stream", methods=["GET"])
+def stream_logs():
+    """Server-Sent Events: one event per new log line, with the seq as its id.
+
+    Accepts the same filters as /api/logs.
+    """
+    return sse_response(server_logs, format_log, log_filter_from_args(request.args))
+
+###############################################################################
+# LIVE STATUS (Apple TV connection / play state, applied room light states)
+###############################################################################
+status_events = EventBuffer(500)
+atv_status = {}         # atv_id => {"connected": bool, "state": str}
+room_status = {}        # room_name => {"state", "on", "bri"} last applied
+
+def publish_status(kind, **fields):
+    """Record a status change and push it to /api/status/stream clients."""
+    fields["type"] = kind
+    # cond is re-entrant; holding it keeps the snapshot and seq consistent
+    with status_events.cond:
+        if kind == "room":
+            room_status[fields["room"]] = {k: fields[k] for k in ("state", "on", "bri")}
+        elif kind == "atv":
+            atv_status.setdefault(fields["atv_id"], {}).update(
+                {k: v for k, v in fields.items() if k not in ("atv_id", "type")})
+        status_events.append(fields)
+
+@app.route("/api/status", methods=["GET"])
+def api_status():
+    """Current snapshot plus the seq to resume /api/status/stream from."""
+    with status_events.cond:
+        return jsonify({
+            "seq": status_events.seq,
+            "apple_tvs": atv_status,
+            "rooms": room_status
+        })
+
+@app.route("/api/status/stream", methods=["GET"])
+def stream_status():
+    """Server-Sent Events: one JSON object per status change (see publish_status)."""
+    return sse_response(status_events, json.dumps)
+
+###############################################################################
+# LATENCY METRICS (Prometheus text format on /api/metrics)
+###############################################################################
+class LatencySummary:
+    """Per-label-set latency quantiles over the most recent `window` samples."""
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, name, help_text, label_names, window=1024):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.window = window
+        self.series = {}    # label values => [deque of samples, sum, count]
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, seconds, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [deque(maxlen=self.window), 0.0, 0]
+            series[0].append(seconds)
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} summary"]
+        with self.lock:
+            snapshot = [(k, sorted(v[0]), v[1], v[2]) for k, v in self.series.items()]
+        for label_values, samples, total, count in snapshot:
+            labels = ",".join(f'{n}="{_prom_escape(v)}"'
+                              for n, v in zip(self.label_names, label_values))
+            sep = "," if labels else ""
+            for q in self.QUANTILES:
+                v = samples[min(len(samples) - 1, int(q * len(samples)))]
+                lines.append(f'{self.name}{{{labels}{sep}quantile="{q}"}} {v:.6f}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+def _prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = []
+
+# Pipeline: play-state event -> rooms resolved -> (settle/queue) -> bridge
+# client ready -> each Hue command -> room done
+m_event_dispatch = LatencySummary(
+    "rnr_event_dispatch_seconds",
+    "Time from an Apple TV play-state event to its rooms being resolved and queued.",
+    ("atv_id",))
+m_queue_wait = LatencySummary(
+    "rnr_queue_wait_seconds",
+    "Time from the play-state event to a Hue worker starting on the room (includes the settle window).",
+    ("room",))
+m_bridge_connect = LatencySummary(
+    "rnr_bridge_connect_seconds",
+    "Time to open a new keep-alive TCP connection to a Hue bridge.",
+    ("bridge",))
+m_bridge_throttle = LatencySummary(
+    "rnr_hue_rate_limit_wait_seconds",
+    "Time a bridge request waited for that bridge's rate limiter.",
+    ("bridge",))
+m_hue_command = LatencySummary(
+    "rnr_hue_command_seconds",
+    "Duration of a single Hue bridge command.",
+    ("bridge", "kind"))
+m_event_to_light = LatencySummary(
+    "rnr_event_to_light_seconds",
+    "End-to-end time from the play-state event to the room's last Hue command returning.",
+    ("room", "bridge"))
+
+@app.route("/api/metrics", methods=["GET"])
+def api_metrics():
+    """Latency summaries (p50/p95/p99) in Prometheus text exposition format."""
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
 
 ###############################################################################
 # DATABASE SETUP
 ###############################################################################
+# One connection per thread (Flask workers, the asyncio loop, Hue workers),
+# opened lazily and kept for the thread's lifetime. WAL lets readers and the
+# single writer proceed concurrently; NORMAL sync skips the per-commit fsync.
+_db_local = threading.local()
+
 def get_connection():
-    return sqlite3.connect(DB_PATH)
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        _db_local.depth = 0
+        _db_local.after_commit = []
+        _db_local.tx = {}       # per-transaction scratch space, see stage_room
+    return conn
+
+@contextmanager
+def db_cursor():
+    """Cursor on this thread's connection; commits when the outermost block exits.
+
+    Nested blocks join the enclosing transaction, so helpers like
+    save_room_db can be grouped into one commit by an outer db_cursor().
+    Hooks registered with after_commit() run once that commit succeeds.
+    """
+    conn = get_connection()
+    _db_local.depth += 1
+    hooks = []
+    try:
+        yield conn.cursor()
+    except Exception:
+        if _db_local.depth == 1:
+            conn.rollback()
+            _db_local.after_commit, _db_local.tx = [], {}
+        raise
+    else:
+        if _db_local.depth == 1:
+            conn.commit()
+            hooks, _db_local.after_commit, _db_local.tx = _db_local.after_commit, [], {}
+    finally:
+        _db_local.depth -= 1
+    for fn in hooks:
+        fn()
+
+def after_commit(fn):
+    """Run fn() when the current transaction commits (never, if it rolls back)."""
+    if getattr(_db_local, "depth", 0) == 0:
+        fn()
+    else:
+        _db_local.after_commit.append(fn)
+
+###############################################################################
+# CACHED READ APIs (serialized once per data version)
+###############################################################################
+# Every write to apple_tvs / hue_bridges / rooms bumps data_version once it
+# commits. Polled read endpoints keep their serialized body until the
+# version moves on and answer If-None-Match with 304. The epoch keeps
+# ETags from an earlier run from matching after a restart.
+DATA_EPOCH = uuid.uuid4().hex[:8]
+data_version = 0
+data_version_lock = threading.Lock()
+response_cache = {}     # key => (version, body, etag)
+
+def bump_data_version():
+    global data_version
+    with data_version_lock:
+        data_version += 1
+
+def data_changed():
+    """Invalidate cached responses when the current transaction commits."""
+    after_commit(bump_data_version)
+
+def cached_json_response(key, build):
+    """Conditional JSON response for build(), rebuilt only after a data change.
+
+    Returns None (and caches nothing) if build() returns None.
+    """
+    version = data_version      # read first: a write during build() re-invalidates
+    hit = response_cache.get(key)
+    if hit is None or hit[0] != version:
+        out = build()
+        if out is None:
+            return None
+        hit = (version, app.json.dumps(out, separators=(",", ":")) + "\n", f"{DATA_EPOCH}-{version}")
+        response_cache[key] = hit
+    resp = Response(hit[1], mimetype="application/json")
+    resp.set_etag(hit[2])
+    return resp.make_conditional(request)
+
+class BatchedWriter:
+    """Coalesce frequent keyed writes and apply them in one transaction.
+
+    put() only records the latest value per key; a background thread calls
+    apply(cursor, {key: value}) at most every `interval` seconds. A value
+    equal to the last one put for that key is ignored.
+    """
+
+    def __init__(self, name, apply, interval=1.0):
+        self.apply = apply
+        self.interval = interval
+        self.pending = {}
+        self.latest = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.latest and self.latest[key] == value:
+                return
+            self.latest[key] = value
+            self.pending[key] = value
+        self.wake.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if batch:
+                with db_cursor() as c:
+                    self.apply(c, batch)
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                append_log("db writer => {ex}", "ERROR", "db", ex=ex)
+
+def add_missing_columns(c, table, columns):
+    """Add columns introduced after an existing DB was first created."""
+    have = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns:
+        if name not in have:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
 
 def create_tables():
     """Create tables for Apple TVs, Hue bridge, and user-defined rooms."""
-    conn = get_connection()
-    c = conn.cursor()
-
-    # Apple TVs
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS apple_tvs (
-        atv_id TEXT PRIMARY KEY,
-        atv_name TEXT,
-        host TEXT,
-        credentials TEXT,
-        is_connected INTEGER DEFAULT 0
-    )
-    """)
-
-    # Hue Bridge
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS hue_bridge (
-        id INTEGER PRIMARY KEY CHECK(id=1),
-        ip TEXT,
-        user TEXT
-    )
-    """)
-
-    # Rooms (store brightness in 0–100)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS rooms (
-        room_name TEXT PRIMARY KEY,
-        apple_tv_id TEXT,
-        hue_bridge_ip TEXT,
-        hue_user TEXT,
-        light_ids TEXT,  -- JSON array
-        playing_bri INTEGER DEFAULT 60,
-        paused_bri  INTEGER DEFAULT 80,
-        stopped_bri INTEGER DEFAULT 100
-    )
-    """)
+    with db_cursor() as c:
+        # Apple TVs
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS apple_tvs (
+            atv_id TEXT PRIMARY KEY,
+            atv_name TEXT,
+            host TEXT,
+            credentials TEXT,
+            is_connected INTEGER DEFAULT 0
+        )
+        """)
+
+        # Hue Bridges (the first one paired is the default for new rooms)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS hue_bridges (
+            ip TEXT PRIMARY KEY,
+            user TEXT,
+            name TEXT,
+            clientkey TEXT  -- hex PSK for entertainment streaming
+        )
+        """)
+        add_missing_columns(c, "hue_bridges", [("clientkey", "TEXT")])
+
+        # Rooms (store brightness in 0–100, fades in milliseconds)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_name TEXT PRIMARY KEY,
+            apple_tv_id TEXT,
+            hue_bridge_ip TEXT,
+            hue_user TEXT,
+            light_ids TEXT,  -- JSON array
+            playing_bri INTEGER DEFAULT 60,
+            paused_bri  INTEGER DEFAULT 80,
+            stopped_bri INTEGER DEFAULT 100,
+            hue_group_id INTEGER,  -- bridge group managed for this room
+            playing_fade_ms INTEGER DEFAULT 400,
+            paused_fade_ms  INTEGER DEFAULT 400,
+            stopped_fade_ms INTEGER DEFAULT 400,
+            stream_area TEXT,  -- entertainment area id; NULL => REST commands
+            profile TEXT  -- JSON array of time-of-day overrides, see compile_profile
+        )
+        """)
+        add_missing_columns(c, "rooms", [
+            ("hue_group_id", "INTEGER"),
+            ("playing_fade_ms", "INTEGER DEFAULT 400"),
+            ("paused_fade_ms", "INTEGER DEFAULT 400"),
+            ("stopped_fade_ms", "INTEGER DEFAULT 400"),
+            ("stream_area", "TEXT"),
+            ("profile", "TEXT"),
+        ])
+
+        # Older DBs held a single bridge in hue_bridge (id=1); rooms may also
+        # point at bridges paired before that row was replaced.
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='hue_bridge'")
+        if c.fetchone():
+            c.execute("""
+            INSERT OR IGNORE INTO hue_bridges(ip, user)
+            SELECT ip, user FROM hue_bridge WHERE ip IS NOT NULL AND ip<>''
+            """)
+            c.execute("DROP TABLE hue_bridge")
+        c.execute("""
+        INSERT OR IGNORE INTO hue_bridges(ip, user)
+        SELECT hue_bridge_ip, hue_user FROM rooms
+        WHERE hue_bridge_ip IS NOT NULL AND hue_bridge_ip<>''
+        GROUP BY hue_bridge_ip
+        """)
 
-    conn.commit()
-    conn.close()
+###############################################################################
+# PLAY-STATE / LIGHT HISTORY (append-only, separate DB file)
+###############################################################################
+# Rows are queued by the hot path and inserted in batches by one writer
+# thread, in a DB file of their own so history never contends with the
+# config tables in DB_PATH. Rows older than HISTORY_RETENTION_DAYS are purged
+# hourly and the freed pages returned with an incremental vacuum.
+HISTORY_COLUMNS = ("ts", "kind", "atv_id", "room", "state", "is_on", "bri", "latency_ms")
+_history_local = threading.local()
+
+def history_connection():
+    conn = getattr(_history_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(HISTORY_DB_PATH, timeout=10)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  # only takes effect on a new file
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            ts REAL NOT NULL,       -- unix time
+            kind TEXT NOT NULL,     -- 'play' (Apple TV transition) or 'light' (applied)
+            atv_id TEXT,
+            room TEXT,
+            state TEXT,
+            is_on INTEGER,
+            bri INTEGER,            -- 0–100
+            latency_ms REAL         -- event => bridge acknowledged ('light' only)
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS history_ts ON history(ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_room_ts ON history(room, ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_atv_ts ON history(atv_id, ts)")
+        conn.commit()
+        _history_local.conn = conn
+    return conn
+
+class HistoryWriter:
+    """Append rows off the hot path; one executemany per `interval` seconds."""
+
+    def __init__(self, interval=1.0, purge_every=3600):
+        self.rows = queue.SimpleQueue()
+        self.interval = interval
+        self.purge_every = purge_every
+        self.last_purge = 0.0
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self._run, name="db-history", daemon=True).start()
+
+    def put(self, *row):
+        self.rows.put(row)
+
+    def flush(self):
+        with self.flush_lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self.rows.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                conn = history_connection()
+                with conn:
+                    conn.executemany(f"INSERT INTO history({', '.join(HISTORY_COLUMNS)}) "
+                                     f"VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})", batch)
+            return len(batch)
+
+    def purge(self):
+        """Drop rows past the retention window and release their pages."""
+        if HISTORY_RETENTION_DAYS <= 0:
+            return 0
+        cutoff = time.time() - HISTORY_RETENTION_DAYS * 86400
+        conn = history_connection()
+        with conn:
+            n = conn.execute("DELETE FROM history WHERE ts < ?", (cutoff,)).rowcount
+        if n:
+            # execute() would step the pragma once, freeing a single page
+            conn.executescript("PRAGMA incremental_vacuum")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            append_log("history => purged {n} row(s) older than {days:g} day(s), "
+                       "{free} free page(s) left", category="db", n=n,
+                       days=HISTORY_RETENTION_DAYS, free=free)
+        return n
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                if time.monotonic() - self.last_purge >= self.purge_every:
+                    self.last_purge = time.monotonic()
+                    self.purge()
+            except Exception as ex:
+                append_log("history writer => {ex}", "ERROR", "db", ex=ex)
+
+history_writer = HistoryWriter()
+last_play_state = {}    # atv_id => last recorded state (only transitions are kept)
+
+def record_play_state(atv_id, state):
+    if last_play_state.get(atv_id) == state:
+        return
+    last_play_state[atv_id] = state
+    history_writer.put(time.time(), "play", atv_id, None, state, None, None, None)
+
+def record_light_state(room_name, atv_id, applied, latency):
+    history_writer.put(time.time(), "light", atv_id, room_name, applied["state"],
+                       1 if applied["on"] else 0, applied["bri"],
+                       None if latency is None else round(latency * 1000, 1))
+
+def parse_history_time(value, default):
+    """Accept unix seconds or an ISO 8601 timestamp (local time if naive)."""
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def query_history(start, end, room=None, atv_id=None, kind=None, limit=1000):
+    """Rows with start <= ts < end, oldest first.
+
+    A room filter also returns the 'play' transitions of the room's Apple TV,
+    so the TV state and the lights that followed it come back together.
+    """
+    where, args = ["ts >= ?", "ts < ?"], [start, end]
+    if room is not None:
+        rcfg = get_room(room)
+        room_atv = rcfg["apple_tv_id"] if rcfg else None
+        where.append("(room = ? OR (kind = 'play' AND atv_id = ?))")
+        args += [room, room_atv]
+    if atv_id is not None:
+        where.append("atv_id = ?")
+        args.append(atv_id)
+    if kind is not None:
+        where.append("kind = ?")
+        args.append(kind)
+    args.append(limit)
+    rows = history_connection().execute(
+        f"SELECT {', '.join(HISTORY_COLUMNS)} FROM history "
+        f"WHERE {' AND '.join(where)} ORDER BY ts LIMIT ?", args).fetchall()
+    return [dict(zip(HISTORY_COLUMNS, r)) for r in rows]
+
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    """Play-state transitions and applied light states in a time range.
+
+    ?from= / ?to= take unix seconds or ISO 8601 (default: the last 24 hours);
+    optional ?room=, ?atv_id=, ?kind=play|light and ?limit= (max 10000).
+    """
+    now = time.time()
+    try:
+        end = parse_history_time(request.args.get("to"), now)
+        start = parse_history_time(request.args.get("from"), end - 86400)
+    except ValueError as ex:
+        return jsonify({"error": f"bad time: {ex}"}), 400
+    limit = max(1, min(request.args.get("limit", 1000, type=int), 10000))
+    history_writer.flush()
+    rows = query_history(start, end, request.args.get("room"), request.args.get("atv_id"),
+                         request.args.get("kind"), limit)
+    return jsonify({"from": start, "to": end, "truncated": len(rows) == limit, "events": rows})
 
 ###############################################################################
 # APPLE TV UTILS
 ###############################################################################
 def save_apple_tv(atv_id, atv_name, host, creds):
     """Insert or update an Apple TV row."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO apple_tvs(atv_id, atv_name, host, credentials, is_connected)
-    VALUES (?, ?, ?, ?, 0)
-    ON CONFLICT(atv_id) DO UPDATE SET
-      atv_name=excluded.atv_name,
-      host=excluded.host,
-      credentials=excluded.credentials
-    """, (atv_id, atv_name, host, creds))
-    conn.commit()
-    conn.close()
-    append_log(f"AppleTV saved => id={atv_id}, name='{atv_name}', host={host}")
+    with db_cursor() as c:
+        c.execute("""
+        INSERT INTO apple_tvs(atv_id, atv_name, host, credentials, is_connected)
+        VALUES (?, ?, ?, ?, 0)
+        ON CONFLICT(atv_id) DO UPDATE SET
+          atv_name=excluded.atv_name,
+          host=excluded.host,
+          credentials=excluded.credentials
+        """, (atv_id, atv_name, host, creds))
+        data_changed()
+    append_log("AppleTV saved => id={atv_id}, name='{name}', host={host}", category="atv",
+               atv_id=atv_id, name=atv_name, host=host)
+
+def _write_connected(c, batch):
+    c.executemany("UPDATE apple_tvs SET is_connected=? WHERE atv_id=?",
+                  [(1 if connected else 0, atv_id) for atv_id, connected in batch.items()])
+
+# Reconnect loops flap is_connected; those writes are batched, not fsync'd each time
+connected_writer = BatchedWriter("db-connected", _write_connected)
 
 def update_apple_tv_connected(atv_id, connected: bool):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE apple_tvs SET is_connected=? WHERE atv_id=?", (1 if connected else 0, atv_id))
-    conn.commit()
-    conn.close()
-    append_log(f"AppleTV => id={atv_id}, connected={connected}")
+    connected_writer.put(atv_id, connected)
+    bump_data_version()     # readers flush connected_writer before querying
+    publish_status("atv", atv_id=atv_id, connected=connected)
+    append_log("AppleTV => id={atv_id}, connected={connected}", category="atv",
+               atv_id=atv_id, connected=connected)
 
 ###############################################################################
 # HUE UTILS
 ###############################################################################
-def save_hue_bridge_db(ip, user):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO hue_bridge(id, ip, user)
-    VALUES(1, ?, ?)
-    ON CONFLICT(id) DO UPDATE SET
-      ip=excluded.ip,
-      user=excluded.user
-    """, (ip, user))
-    conn.commit()
-    conn.close()
-    append_log(f"Hue Bridge => ip={ip}, user={user}")
-
-def load_hue_bridge():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT ip, user FROM hue_bridge WHERE id=1")
-    row = c.fetchone()
-    conn.close()
+def save_hue_bridge_db(ip, user, name=None, clientkey=None):
+    """Add a bridge, or store a new user token for one already known.
+
+    Rooms on that bridge pick up the new token as well. Cached clients and
+    the entertainment stream are only reset if the credentials changed.
+    """
+    with db_cursor() as c:
+        c.execute("SELECT user, clientkey FROM hue_bridges WHERE ip=?", (ip,))
+        old = c.fetchone()
+        c.execute("""
+        INSERT INTO hue_bridges(ip, user, name, clientkey)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(ip) DO UPDATE SET
+          user=excluded.user,
+          name=COALESCE(excluded.name, hue_bridges.name),
+          clientkey=COALESCE(excluded.clientkey, hue_bridges.clientkey)
+        """, (ip, user, name, clientkey))
+        c.execute("UPDATE rooms SET hue_user=? WHERE hue_bridge_ip=?", (user, ip))
+        data_changed()
+        for rn, rcfg in list(rooms_by_name.items()):
+            if rcfg["hue_bridge_ip"] == ip and rcfg["hue_user"] != user:
+                stage_room(rn, dict(rcfg, hue_user=user))
+        if old is not None and tuple(old) != (user, clientkey or old[1]):
+            # stop_light_streamer may talk to the bridge; not while holding the write lock
+            after_commit(lambda: (drop_hue_clients(ip), stop_light_streamer(ip)))
+    append_log("Hue Bridge => ip={ip}, user={user}", category="hue", ip=ip, user=user)
+
+def load_hue_bridges():
+    """All paired bridges, default (first paired) first."""
+    with db_cursor() as c:
+        c.execute("SELECT ip, user, name, clientkey FROM hue_bridges ORDER BY rowid")
+        rows = c.fetchall()
+    return [{"ip": ip, "user": usr, "name": name, "clientkey": key}
+            for (ip, usr, name, key) in rows]
+
+def load_hue_bridge(ip=None):
+    """The bridge at `ip`, or the default bridge; None if not paired."""
+    with db_cursor() as c:
+        if ip is None:
+            c.execute("SELECT ip, user, name, clientkey FROM hue_bridges ORDER BY rowid LIMIT 1")
+        else:
+            c.execute("SELECT ip, user, name, clientkey FROM hue_bridges WHERE ip=?", (ip,))
+        row = c.fetchone()
     if row:
-        (ip, usr) = row
-        return {"ip": ip, "user": usr}
+        (ip, usr, name, key) = row
+        return {"ip": ip, "user": usr, "name": name, "clientkey": key}
     return None
 
+def public_bridge(hb):
+    """Bridge record for API responses (the streaming key stays server-side)."""
+    out = {k: v for k, v in hb.items() if k != "clientkey"}
+    out["entertainment"] = bool(hb.get("clientkey"))
+    return out
+
+def delete_hue_bridge_db(ip):
+    with db_cursor() as c:
+        c.execute("DELETE FROM hue_bridges WHERE ip=?", (ip,))
+        rc = c.rowcount
+        data_changed()
+    drop_hue_clients(ip)
+    stop_light_streamer(ip)
+    forget_light_states(ip)
+    with inventory_lock:
+        hue_inventory.pop(ip, None)
+    return rc
+
+###############################################################################
+# HUE CLIENT POOL (one keep-alive client per (ip, user))
+###############################################################################
+class PooledBridge(Bridge):
+    """phue Bridge that reuses keep-alive HTTP connections.
+
+    Stock phue opens and closes an HTTPConnection per request. Here up to
+    HUE_WORKERS connections per bridge are kept open and handed out one
+    request at a time, so a bridge's workers reach it in parallel (the
+    bridge's TokenBucket still caps the request rate). Connections the
+    bridge dropped are replaced lazily.
+    """
+
+    def __init__(self, ip, username):
+        self._idle = []     # open connections not in use
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(HUE_WORKERS)
+        self._closed = False
+        super().__init__(ip, username=username)
+
+    def _connect(self):
+        conn = http.client.HTTPConnection(self.ip, timeout=10)
+        t = time.monotonic()
+        conn.connect()
+        m_bridge_connect.observe(time.monotonic() - t, self.ip)
+        return conn
+
+    def _release(self, conn):
+        with self._pool_lock:
+            if not self._closed:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, mode="GET", address=None, data=None):
+        body = json.dumps(data) if mode in ("PUT", "POST") else None
+        waited = bridge_limiter(self.ip).acquire()
+        if waited:
+            m_bridge_throttle.observe(waited, self.ip)
+        with self._slots:
+            while True:
+                with self._pool_lock:
+                    conn = self._idle.pop() if self._idle else None
+                reused = conn is not None
+                try:
+                    if not reused:
+                        conn = self._connect()
+                    conn.request(mode, address, body)
+                    raw = conn.getresponse().read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    if conn is not None:
+                        conn.close()
+                    # A kept-alive socket may have been closed by the bridge
+                    # in the meantime; retry on a fresh connection.
+                    if not reused:
+                        raise
+            self._release(conn)
+        return json.loads(raw.decode("utf-8"))
+
+    def close(self):
+        with self._pool_lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+class TokenBucket:
+    """`rate` tokens per second, at most `burst` saved up; rate <= 0 = unlimited.
+
+    acquire() reserves a token and sleeps until it is due, so callers are
+    served in arrival order instead of retrying.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token; return the seconds spent waiting for it."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+# One limiter per bridge, shared by every client and thread talking to it
+bridge_limiters = {}
+bridge_limiters_lock = threading.Lock()
+
+def bridge_limiter(ip):
+    with bridge_limiters_lock:
+        bucket = bridge_limiters.get(ip)
+        if bucket is None:
+            bucket = bridge_limiters[ip] = TokenBucket(BRIDGE_RATE, BRIDGE_BURST)
+    return bucket
+
+hue_clients = {}
+hue_clients_lock = threading.Lock()
+
+def get_hue_client(ip, user):
+    """Return the shared Hue client for (ip, user), creating it on first use."""
+    key = (ip, user)
+    with hue_clients_lock:
+        b = hue_clients.get(key)
+        if b is None:
+            b = PooledBridge(ip, user)
+            hue_clients[key] = b
+    return b
+
+def drop_hue_clients(ip=None, user=None):
+    """Close and forget cached clients matching ip/user (None matches any)."""
+    with hue_clients_lock:
+        keys = [k for k in hue_clients
+                if (ip is None or k[0] == ip) and (user is None or k[1] == user)]
+        dropped = [hue_clients.pop(k) for k in keys]
+    for b in dropped:
+        b.close()
+
 ###############################################################################
 # ROOMS UTILS
 ###############################################################################
 def save_room_db(room_name, atv_id, hue_bridge_ip, hue_user,
-                 light_ids, playing_bri, paused_bri, stopped_bri):
+                 light_ids, playing_bri, paused_bri, stopped_bri,
+                 playing_fade_ms=400, paused_fade_ms=400, stopped_fade_ms=400,
+                 stream_area=None, profile=None):
     lids_json = json.dumps(light_ids)
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO rooms
-    (room_name, apple_tv_id, hue_bridge_ip, hue_user,
-     light_ids, playing_bri, paused_bri, stopped_bri)
-    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(room_name) DO UPDATE SET
-      apple_tv_id=excluded.apple_tv_id,
-      hue_bridge_ip=excluded.hue_bridge_ip,
-      hue_user=excluded.hue_user,
-      light_ids=excluded.light_ids,
-      playing_bri=excluded.playing_bri,
-      paused_bri=excluded.paused_bri,
-      stopped_bri=excluded.stopped_bri
-    """, (
-        room_name, atv_id, hue_bridge_ip, hue_user,
-        lids_json, playing_bri, paused_bri, stopped_bri
-    ))
-    conn.commit()
-    conn.close()
-    append_log(f"Room saved => room='{room_name}', apple_tv_id='{atv_id}', "
-               f"hue_ip={hue_bridge_ip}, user={hue_user}, lights={light_ids}, "
-               f"playing={playing_bri}, paused={paused_bri}, stopped={stopped_bri}")
+    profile = list(profile or [])
+    old = get_room(room_name)
+    # A bridge group id means nothing on another bridge
+    gid = old.get("hue_group_id") if old and old["hue_bridge_ip"] == hue_bridge_ip else None
+    rcfg = {
+        "apple_tv_id":   atv_id,
+        "hue_bridge_ip": hue_bridge_ip,
+        "hue_user":      hue_user,
+        "light_ids":     list(light_ids),
+        "playing_bri":   playing_bri,
+        "paused_bri":    paused_bri,
+        "stopped_bri":   stopped_bri,
+        "hue_group_id":  gid,
+        "playing_fade_ms": playing_fade_ms,
+        "paused_fade_ms":  paused_fade_ms,
+        "stopped_fade_ms": stopped_fade_ms,
+        "stream_area":     stream_area,
+        "profile":         profile
+    }
+    rcfg["schedule"] = compile_profile(rcfg)
+    with db_cursor() as c:
+        c.execute("""
+        INSERT INTO rooms
+        (room_name, apple_tv_id, hue_bridge_ip, hue_user,
+         light_ids, playing_bri, paused_bri, stopped_bri, hue_group_id,
+         playing_fade_ms, paused_fade_ms, stopped_fade_ms, stream_area, profile)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(room_name) DO UPDATE SET
+          apple_tv_id=excluded.apple_tv_id,
+          hue_bridge_ip=excluded.hue_bridge_ip,
+          hue_user=excluded.hue_user,
+          light_ids=excluded.light_ids,
+          playing_bri=excluded.playing_bri,
+          paused_bri=excluded.paused_bri,
+          stopped_bri=excluded.stopped_bri,
+          hue_group_id=excluded.hue_group_id,
+          playing_fade_ms=excluded.playing_fade_ms,
+          paused_fade_ms=excluded.paused_fade_ms,
+          stopped_fade_ms=excluded.stopped_fade_ms,
+          stream_area=excluded.stream_area,
+          profile=excluded.profile
+        """, (
+            room_name, atv_id, hue_bridge_ip, hue_user,
+            lids_json, playing_bri, paused_bri, stopped_bri, gid,
+            playing_fade_ms, paused_fade_ms, stopped_fade_ms, stream_area,
+            json.dumps(profile) if profile else None
+        ))
+        stage_room(room_name, rcfg)
+        data_changed()
+        if old and old.get("stream_area") and \
+                (old["hue_bridge_ip"], old["stream_area"]) != (hue_bridge_ip, stream_area):
+            after_commit(lambda: stop_light_streamer(old["hue_bridge_ip"]))
+        if old and old.get("hue_group_id") is not None and old["hue_bridge_ip"] != hue_bridge_ip:
+            # The group stays behind on the old bridge otherwise
+            after_commit(lambda: bridge_executor(old["hue_bridge_ip"]).submit(
+                delete_room_group, room_name, old))
+    append_log("Room saved => room='{room}', apple_tv_id='{atv_id}', "
+               "hue_ip={ip}, user={user}, lights={lights}, "
+               "playing={p}, paused={pa}, stopped={s}, fades_ms={pf}/{paf}/{sf}, "
+               "stream_area={area}, profile_periods={periods}",
+               category="room", room=room_name, atv_id=atv_id,
+               ip=hue_bridge_ip, user=hue_user, lights=light_ids,
+               p=playing_bri, pa=paused_bri, s=stopped_bri,
+               pf=playing_fade_ms, paf=paused_fade_ms, sf=stopped_fade_ms,
+               area=stream_area, periods=len(profile))
 
 def load_rooms_from_db():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("""
-    SELECT room_name, apple_tv_id, hue_bridge_ip, hue_user,
-           light_ids, playing_bri, paused_bri, stopped_bri
-    FROM rooms
-    """)
-    rows = c.fetchall()
-    conn.close()
+    with db_cursor() as c:
+        c.execute("""
+        SELECT room_name, apple_tv_id, hue_bridge_ip, hue_user,
+               light_ids, playing_bri, paused_bri, stopped_bri, hue_group_id,
+               playing_fade_ms, paused_fade_ms, stopped_fade_ms, stream_area, profile
+        FROM rooms
+        """)
+        rows = c.fetchall()
 
     out = {}
-    for (rn, aid, hbip, hbusr, lids_j, pb, pab, sb) in rows:
+    for (rn, aid, hbip, hbusr, lids_j, pb, pab, sb, gid, pf, paf, sf, area, prof_j) in rows:
         lids = json.loads(lids_j) if lids_j else []
         out[rn] = {
             "apple_tv_id":   aid,
@@ -224,148 +1129,999 @@ def load_rooms_from_db():
             "light_ids":     lids,
             "playing_bri":   pb,
             "paused_bri":    pab,
-            "stopped_bri":   sb
+            "stopped_bri":   sb,
+            "hue_group_id":  gid,
+            "playing_fade_ms": pf,
+            "paused_fade_ms":  paf,
+            "stopped_fade_ms": sf,
+            "stream_area":     area,
+            "profile":         json.loads(prof_j) if prof_j else []
         }
     return out
 
+def save_room_group_db(room_name, group_id):
+    """Remember which bridge group belongs to a room (None clears it)."""
+    with db_cursor() as c:
+        c.execute("UPDATE rooms SET hue_group_id=? WHERE room_name=?", (group_id, room_name))
+        data_changed()
+        rinfo = get_room(room_name)
+        if rinfo is not None:
+            stage_room(room_name, dict(rinfo, hue_group_id=group_id))
+    append_log("Room group => room='{room}', hue_group_id={gid}", category="room",
+               room=room_name, gid=group_id)
+
 def delete_room_db(room_name):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM rooms WHERE room_name=?", (room_name,))
-    rc = c.rowcount
-    conn.commit()
-    conn.close()
+    with db_cursor() as c:
+        c.execute("DELETE FROM rooms WHERE room_name=?", (room_name,))
+        rc = c.rowcount
+        stage_room(room_name, None)
+        data_changed()
     return rc
 
+###############################################################################
+# ROOM ROUTING INDEX (atv_id => rooms, kept in memory)
+###############################################################################
+# Both dicts are replaced wholesale on every write so readers on the asyncio
+# thread can use them without taking the lock. Writers stage their changes
+# and the whole transaction's worth is swapped in once it commits.
+rooms_lock = threading.Lock()
+rooms_by_name = {}
+rooms_by_atv = {}
+
+def _build_atv_index(by_name):
+    by_atv = {}
+    for rn, rcfg in by_name.items():
+        by_atv.setdefault(rcfg["apple_tv_id"], []).append((rn, rcfg))
+    return by_atv
+
+def reload_room_index():
+    """Rebuild the room index from the DB (startup, or after external DB edits)."""
+    global rooms_by_name, rooms_by_atv
+    with rooms_lock:
+        by_name = load_rooms_from_db()
+        for rcfg in by_name.values():
+            rcfg["schedule"] = compile_profile(rcfg)
+        rooms_by_name = by_name
+        rooms_by_atv = _build_atv_index(by_name)
+    bump_data_version()     # the DB may have been edited behind the cached responses
+    append_log("Room index => loaded {n} room(s)", category="room", n=len(by_name))
+
+def index_rooms(changes):
+    """Apply {room_name: cfg, or None if deleted} to the index in one swap."""
+    global rooms_by_name, rooms_by_atv
+    with rooms_lock:
+        by_name = dict(rooms_by_name)
+        for room_name, rcfg in changes.items():
+            if rcfg is None:
+                by_name.pop(room_name, None)
+            else:
+                by_name[room_name] = rcfg
+        rooms_by_name = by_name
+        rooms_by_atv = _build_atv_index(by_name)
+
+def stage_room(room_name, rcfg):
+    """Index rcfg (None = removed) once the enclosing db_cursor() commits."""
+    staged = _db_local.tx.get("rooms")
+    if staged is None:
+        staged = _db_local.tx["rooms"] = {}
+        after_commit(lambda: index_rooms(staged))
+    staged[room_name] = rcfg
+
+def get_room(room_name):
+    return rooms_by_name.get(room_name)
+
+def rooms_for_atv(atv_id):
+    """Return [(room_name, room_cfg), ...] linked to this Apple TV."""
+    return rooms_by_atv.get(atv_id, [])
+
+###############################################################################
+# HUE ROOM GROUPS (one bridge group per room => one command per state change)
+###############################################################################
+# room_name => (bridge ip, group_id, light_ids) already verified on the bridge this run
+room_groups_synced = {}
+# One lock per room, so concurrent events can't each create a group for it
+room_group_locks = {}
+room_group_locks_lock = threading.Lock()
+
+def hue_ok(resp):
+    """True if a phue PUT/POST response list carries no error entries."""
+    if not resp:
+        return False
+    # set_light/set_group return one response list per target
+    entries = resp if isinstance(resp[0], dict) else [e for r in resp for e in r]
+    return not any("error" in e for e in entries)
+
+def hue_group_name(room_name):
+    return f"RnR {room_name}"[:32]
+
+def hue_error_types(resp):
+    """Error type numbers in a phue response list (3 = resource not available)."""
+    if not resp:
+        return set()
+    entries = resp if isinstance(resp[0], dict) else [e for r in resp for e in r]
+    return {e["error"].get("type") for e in entries if isinstance(e.get("error"), dict)}
+
+def ensure_room_group(b, room_name, rinfo):
+    """Return a bridge group id holding exactly this room's lights, or None.
+
+    `rinfo` may be the snapshot taken when the event arrived; the group id
+    is read from the live index, which a concurrent creation has updated.
+    """
+    ip, lids = rinfo["hue_bridge_ip"], tuple(rinfo["light_ids"])
+    with room_group_locks_lock:
+        lock = room_group_locks.setdefault(room_name, threading.Lock())
+    with lock:
+        synced = room_groups_synced.get(room_name)
+        if synced is not None and synced[0] == ip:
+            gid = synced[1]
+            if synced[2] == lids:
+                return gid
+        else:
+            live = get_room(room_name) or rinfo
+            gid = live.get("hue_group_id") if live["hue_bridge_ip"] == ip else None
+        try:
+            if gid is not None:
+                resp = b.set_group(gid, "lights", list(lids))
+                if not hue_ok(resp):
+                    if 3 not in hue_error_types(resp):
+                        return None     # transient; don't replace a group that exists
+                    gid = None          # deleted on the bridge
+            if gid is None:
+                resp = b.create_group(hue_group_name(room_name), list(lids))
+                gid = int(resp[0]["success"]["id"])
+                save_room_group_db(room_name, gid)
+        except Exception as ex:
+            append_log("hue group => room='{room}', ex={ex}", "WARN", "hue", room=room_name, ex=ex)
+            return None
+        room_groups_synced[room_name] = (ip, gid, lids)
+        return gid
+
+def delete_room_group(room_name, rinfo):
+    """Best-effort removal of a room's bridge group (room deleted or moved away)."""
+    gid = rinfo.get("hue_group_id")
+    synced = room_groups_synced.get(room_name)
+    if synced is not None and synced[0] == rinfo["hue_bridge_ip"]:
+        if gid is None:
+            gid = synced[1]     # created after `rinfo` was read
+        if synced[1] == gid:
+            room_groups_synced.pop(room_name, None)
+    if gid is None or not rinfo["hue_bridge_ip"] or not rinfo["hue_user"]:
+        return
+    try:
+        get_hue_client(rinfo["hue_bridge_ip"], rinfo["hue_user"]).delete_group(gid)
+    except Exception as ex:
+        append_log("hue group delete => room='{room}', ex={ex}", "WARN", "hue",
+                   room=room_name, ex=ex)
+
+###############################################################################
+# HUE LIGHT STATE CACHE (skip commands for lights already in the target state)
+###############################################################################
+light_states = {}       # (bridge_ip, str(light_id)) => {"on": bool, "bri": int, "ct": int}
+light_states_lock = threading.Lock()
+
+def light_needs_update(ip, lid, body):
+    st = light_states.get((ip, str(lid)))
+    if st is None or st.get("on") != body["on"]:
+        return True
+    return body["on"] and (st.get("bri") != body["bri"] or
+                           ("ct" in body and st.get("ct") != body["ct"]))
+
+def remember_light_states(ip, lids, body):
+    with light_states_lock:
+        for lid in lids:
+            st = light_states.setdefault((ip, str(lid)), {})
+            st.update(body)
+
+def forget_light_states(ip, lids=None):
+    with light_states_lock:
+        if lids is None:
+            keys = [k for k in light_states if k[0] == ip]
+        else:
+            keys = [(ip, str(lid)) for lid in lids]
+        for k in keys:
+            light_states.pop(k, None)
+
+###############################################################################
+# HUE LIGHT INVENTORY (cached /lights per bridge, refreshed in the background)
+###############################################################################
+# bridge ip => {"lights": {id: {...}}, "etag": str, "fetched": monotonic,
+#               "stale": True if the latest refresh attempt failed}
+hue_inventory = {}
+inventory_refreshing = set()
+inventory_lock = threading.Lock()
+
+def refresh_hue_inventory(ip, user):
+    """Fetch /lights once; update the inventory and the light state cache."""
+    try:
+        lights = get_hue_client(ip, user).get_light()
+        if not isinstance(lights, dict):
+            raise Exception(f"unexpected /lights response => {lights}")
+    except Exception:
+        with inventory_lock:
+            if ip in hue_inventory:
+                hue_inventory[ip]["stale"] = True
+        drop_hue_clients(ip, user)
+        raise
+    inv_lights = {}
+    fresh = {}
+    for lid, info in lights.items():
+        st = info.get("state", {})
+        inv_lights[str(lid)] = {
+            "name":      info.get("name"),
+            "type":      info.get("type"),
+            "reachable": st.get("reachable"),
+            "on":        st.get("on"),
+            "bri":       st.get("bri")
+        }
+        fresh[(ip, str(lid))] = {"on": st.get("on"), "bri": st.get("bri"), "ct": st.get("ct")}
+    etag = hashlib.sha1(json.dumps(inv_lights, sort_keys=True).encode()).hexdigest()
+    inv = {"lights": inv_lights, "etag": etag, "fetched": time.monotonic(), "stale": False}
+    with inventory_lock:
+        hue_inventory[ip] = inv
+    with light_states_lock:
+        for k in [k for k in light_states if k[0] == ip]:
+            del light_states[k]
+        light_states.update(fresh)
+    return inv
+
+def _refresh_hue_inventory_quietly(ip, user):
+    try:
+        refresh_hue_inventory(ip, user)
+    except Exception as ex:
+        append_log("hue inventory refresh => ip={ip}, ex={ex}", "WARN", "hue", ip=ip, ex=ex)
+        forget_light_states(ip)
+    finally:
+        with inventory_lock:
+            inventory_refreshing.discard(ip)
+
+def schedule_inventory_refresh(ip, user):
+    """Refresh one bridge's inventory in the background (once at a time)."""
+    with inventory_lock:
+        if ip in inventory_refreshing:
+            return
+        inventory_refreshing.add(ip)
+    bridge_executor(ip).submit(_refresh_hue_inventory_quietly, ip, user)
+
+def known_hue_bridges():
+    bridges = {(r["hue_bridge_ip"], r["hue_user"]) for r in rooms_by_name.values()
+               if r["hue_bridge_ip"] and r["hue_user"]}
+    bridges.update((hb["ip"], hb["user"]) for hb in load_hue_bridges()
+                   if hb["ip"] and hb["user"])
+    return bridges
+
+async def refresh_hue_inventory_forever():
+    """Periodically resync so lights/changes made outside the app are seen."""
+    while True:
+        for ip, user in known_hue_bridges():
+            schedule_inventory_refresh(ip, user)
+        await asyncio.sleep(LIGHT_REFRESH_SEC)
+
+###############################################################################
+# HUE ENTERTAINMENT STREAMING (fixed-rate frames instead of REST commands)
+###############################################################################
+# Rooms with a stream_area (an entertainment area/group id on their bridge)
+# are driven by a per-bridge send loop: set_target() only records the goal
+# and fade, and every 1/STREAM_FPS seconds the loop sends the interpolated
+# level of every light. Frames use the HueStream v1 layout (RGB, at most 10
+# lights per message); the transport is DTLS-PSK on real bridges or plain
+# UDP for a local stand-in. A bridge streams one area at a time.
+HUESTREAM_LIGHTS_PER_MSG = 10
+STREAM_RETRY_SEC = 60
+
+class UdpStreamTransport:
+    def __init__(self, host, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+
+    def send(self, payload):
+        self.sock.send(payload)
+
+    def close(self):
+        self.sock.close()
+
+class DtlsStreamTransport(UdpStreamTransport):
+    """DTLS 1.2 PSK (identity = bridge user, key = clientkey) via python-mbedtls."""
+
+    def __init__(self, host, port, identity, clientkey):
+        try:
+            from mbedtls import tls
+        except ImportError:
+            raise RuntimeError("DTLS streaming needs python-mbedtls (pip install python-mbedtls)")
+        conf = tls.DTLSConfiguration(
+            pre_shared_key=(identity, bytes.fromhex(clientkey)),
+            ciphers=("TLS-PSK-WITH-AES-128-GCM-SHA256",),
+            validate_certificates=False)
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        raw.settimeout(5)
+        self.sock = tls.ClientContext(conf).wrap_socket(raw, server_hostname=None)
+        self.sock.connect((host, port))
+        while True:
+            try:
+                self.sock.do_handshake()
+                break
+            except (tls.WantReadError, tls.WantWriteError):
+                continue
+
+def huestream_messages(seq, levels):
+    """Encode [(light_id, 0.0–1.0), ...] as HueStream v1 RGB messages."""
+    out = []
+    for i in range(0, len(levels), HUESTREAM_LIGHTS_PER_MSG):
+        chunk = levels[i:i + HUESTREAM_LIGHTS_PER_MSG]
+        header = struct.pack(">9sBBBHBB", b"HueStream", 1, 0, (seq + len(out)) & 0xFF, 0, 0, 0)
+        body = b"".join(struct.pack(">BHHHH", 0, lid, v, v, v)
+                        for lid, v in ((lid, int(round(level * 0xFFFF))) for lid, level in chunk))
+        out.append(header + body)
+    return out
+
+class LightStreamer:
+    """Send loop for one bridge's entertainment area."""
+
+    def __init__(self, ip, user, area, transport, fps=STREAM_FPS):
+        self.ip = ip
+        self.user = user
+        self.area = area
+        self.transport = transport
+        self.period = 1.0 / fps
+        self.tracks = {}    # light id => (from_level, to_level, t_start, t_end)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.frames = 0
+        self.errors = 0
+        self.running = True
+        threading.Thread(target=self._run, name=f"stream-{ip}", daemon=True).start()
+
+    @staticmethod
+    def _level(track, now):
+        if track is None:
+            return 0.0
+        start, end, t0, t1 = track
+        if now >= t1:
+            return end
+        return start + (end - start) * (now - t0) / (t1 - t0)
+
+    def _start_level(self, lid, default):
+        """Where a light not streamed yet starts from: its last known REST state."""
+        st = light_states.get((self.ip, str(lid)))
+        if not st or st.get("on") is None:
+            return default      # unknown: jump straight to the target
+        if not st["on"] or not st.get("bri"):
+            return 0.0
+        return st["bri"] / 254
+
+    def set_target(self, lids, level, fade_sec):
+        """Fade `lids` from wherever they are now to `level` (0.0–1.0)."""
+        now = time.monotonic()
+        with self.lock:
+            for lid in lids:
+                lid = int(lid)
+                track = self.tracks.get(lid)
+                if track is None:
+                    cur = self._start_level(lid, level)
+                else:
+                    cur = self._level(track, now)
+                self.tracks[lid] = (cur, level, now, now + max(fade_sec, 0.0))
+
+    def _run(self):
+        due = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                levels = [(lid, self._level(tr, now)) for lid, tr in self.tracks.items()]
+            msgs = huestream_messages(self.seq, levels)
+            self.seq = (self.seq + len(msgs)) & 0xFF
+            try:
+                for msg in msgs:
+                    self.transport.send(msg)
+                self.frames += 1
+            except OSError as ex:
+                self.errors += 1
+                if self.errors == 1:
+                    append_log("stream send => ip={ip}, ex={ex}", "WARN", "hue",
+                               ip=self.ip, ex=ex)
+            due += self.period
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                due = time.monotonic()      # fell behind; don't send a burst
+
+    def stop(self):
+        self.running = False
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+light_streamers = {}    # bridge ip => LightStreamer
+stream_failures = {}    # bridge ip => monotonic time of the last failed start
+stream_starting = set() # bridge ips whose streamer is being started (I/O outside the lock)
+stream_cancelled = set()    # ... and stop_light_streamer was called meanwhile
+light_streamers_lock = threading.Lock()
+
+def set_stream_active(ip, user, area, active):
+    b = get_hue_client(ip, user)
+    return hue_ok(b.request("PUT", f"/api/{user}/groups/{area}", {"stream": {"active": active}}))
+
+def open_stream_transport(ip, user, clientkey):
+    host = ip.split(":")[0]     # a port in the bridge address is for REST only
+    if STREAM_TRANSPORT == "udp":
+        return UdpStreamTransport(host, STREAM_PORT)
+    if not clientkey:
+        raise RuntimeError("bridge has no entertainment clientkey; re-pair with entertainment on")
+    return DtlsStreamTransport(host, STREAM_PORT, user, clientkey)
+
+def get_light_streamer(ip, user, area):
+    """The running streamer for (bridge, area), starting it if needed.
+
+    Returns None when streaming is unavailable, so callers fall back to REST.
+    """
+    area = str(area)
+    with light_streamers_lock:
+        st = light_streamers.get(ip)
+        if st is not None:
+            return st if st.area == area else None
+        failed = stream_failures.get(ip)
+        if failed is not None and time.monotonic() - failed < STREAM_RETRY_SEC:
+            return None
+        if ip in stream_starting:
+            return None     # another room is starting it; use REST meanwhile
+        stream_starting.add(ip)
+    # Bridge I/O and the DTLS handshake happen unlocked, so a slow bridge
+    # doesn't hold up streams on the others
+    st = None
+    try:
+        hb = load_hue_bridge(ip) or {}
+        if not set_stream_active(ip, user, area, True):
+            raise RuntimeError(f"bridge refused to start streaming area {area}")
+        st = LightStreamer(ip, user, area, open_stream_transport(ip, user, hb.get("clientkey")))
+    except Exception as ex:
+        with light_streamers_lock:
+            stream_starting.discard(ip)
+            stream_cancelled.discard(ip)
+            stream_failures[ip] = time.monotonic()
+        append_log("stream start => ip={ip}, area={area}, ex={ex}; using REST",
+                   "WARN", "hue", ip=ip, area=area, ex=ex)
+        return None
+    with light_streamers_lock:
+        stream_starting.discard(ip)
+        cancelled = ip in stream_cancelled
+        stream_cancelled.discard(ip)
+        if not cancelled:
+            stream_failures.pop(ip, None)
+            light_streamers[ip] = st
+    if cancelled:
+        st.stop()
+        try:
+            set_stream_active(ip, user, area, False)
+        except Exception:
+            pass
+        return None
+    append_log("Streaming => ip={ip}, area={area}, transport={transport}, fps={fps:g}",
+               category="hue", ip=ip, area=area, transport=STREAM_TRANSPORT, fps=STREAM_FPS)
+    return st
+
+def stop_light_streamer(ip=None):
+    """Stop streaming to one bridge (or all) and hand the area back to the bridge."""
+    with light_streamers_lock:
+        ips = list(light_streamers) if ip is None else [ip]
+        stopped = [light_streamers.pop(i) for i in ips if i in light_streamers]
+        stream_cancelled.update(stream_starting if ip is None else stream_starting & {ip})
+        for i in ips:
+            stream_failures.pop(i, None)
+    for st in stopped:
+        st.stop()
+        try:
+            set_stream_active(st.ip, st.user, st.area, False)
+        except Exception:
+            pass
+
+###############################################################################
+# TIME-OF-DAY PROFILES (compiled per room, looked up per event)
+###############################################################################
+# A room's "profile" is a list of periods overriding its brightness, and
+# optionally setting a colour temperature, for part of the day:
+#   {"start": "22:00", "end": "06:00", "paused_bri": 20, "paused_ct": 450}
+# Periods may wrap midnight; start == end covers the whole day. Where
+# periods overlap, fields set by the later one win. Once any period sets a
+# ct, every other time and state gets PROFILE_DEFAULT_CT, so lights don't
+# stay at a night-time colour. Saving a room compiles the profile
+# into a per-minute table, so resolving a target is one index operation.
+PROFILE_STATES = ("playing", "paused", "stopped")
+PROFILE_FIELDS = tuple(f"{st}_{k}" for st in PROFILE_STATES for k in ("bri", "ct"))
+MAX_PROFILE_PERIODS = 48
+
+def profile_minute(hhmm):
+    """Minute of the day for "HH:MM". Raises ValueError."""
+    try:
+        h, m = (int(x) for x in hhmm.split(":"))
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"bad time {hhmm!r}, expected HH:MM")
+    if not (0 <= h < 24 and 0 <= m < 60):
+        raise ValueError(f"bad time {hhmm!r}, expected HH:MM")
+    return h * 60 + m
+
+def parse_profile(profile):
+    """Validate a profile list and return it normalized. Raises ValueError."""
+    if profile is None:
+        return []
+    if not isinstance(profile, list):
+        raise ValueError("profile must be a list")
+    if len(profile) > MAX_PROFILE_PERIODS:
+        raise ValueError(f"profile has more than {MAX_PROFILE_PERIODS} periods")
+    out = []
+    for i, period in enumerate(profile):
+        if not isinstance(period, dict):
+            raise ValueError(f"profile[{i}] must be an object")
+        unknown = set(period) - {"start", "end"} - set(PROFILE_FIELDS)
+        if unknown:
+            raise ValueError(f"profile[{i}]: unknown field(s) {', '.join(sorted(unknown))}")
+        try:
+            p = {"start": period.get("start"), "end": period.get("end")}
+            profile_minute(p["start"])
+            profile_minute(p["end"])
+        except ValueError as ex:
+            raise ValueError(f"profile[{i}]: {ex}")
+        for key in PROFILE_FIELDS:
+            if key not in period or period[key] is None:
+                continue
+            try:
+                v = int(period[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"profile[{i}]: {key} must be an integer")
+            lo, hi = (0, 100) if key.endswith("_bri") else (153, 500)
+            if not lo <= v <= hi:
+                raise ValueError(f"profile[{i}]: {key} must be {lo}–{hi}")
+            p[key] = v
+        out.append(p)
+    return out
+
+def compile_profile(rcfg):
+    """Precompute a room's targets as (slots, targets).
+
+    targets[i] maps play state => (brightness %, ct in mireds or None);
+    slots[minute of day] indexes targets, or slots is None when the room has
+    no profile and targets[0] (the room's fixed levels) always applies.
+    """
+    periods = rcfg.get("profile") or []
+    default_ct = None
+    if any(f"{st}_ct" in p for p in periods for st in PROFILE_STATES):
+        default_ct = PROFILE_DEFAULT_CT
+    base = {st: (rcfg[f"{st}_bri"], default_ct) for st in PROFILE_STATES}
+    if not periods:
+        return None, [base]
+    covering = [() for _ in range(24 * 60)]    # minute => indexes of periods active
+    for i, period in enumerate(periods):
+        start, end = profile_minute(period["start"]), profile_minute(period["end"])
+        for m in range(start, start + ((end - start) % 1440 or 1440)):
+            covering[m % 1440] += (i,)
+    targets = [base]
+    index = {(): 0}
+    slots = bytearray(24 * 60)
+    for m, active in enumerate(covering):
+        if active not in index:
+            fields = {}
+            for i in active:
+                fields.update(periods[i])
+            index[active] = len(targets)
+            targets.append({st: (fields.get(f"{st}_bri", base[st][0]),
+                                 fields.get(f"{st}_ct", default_ct))
+                            for st in PROFILE_STATES})
+        slots[m] = index[active]
+    return bytes(slots), targets
+
+def room_target(rinfo, state):
+    """(brightness %, ct or None) for a room in `state` at the current local time."""
+    slots, targets = rinfo.get("schedule") or compile_profile(rinfo)
+    target = targets[0]
+    if slots is not None:
+        now = time.localtime()
+        target = targets[slots[now.tm_hour * 60 + now.tm_min]]
+    return target.get(state, target["stopped"])
+
 ###############################################################################
 # HUE LIGHT CONTROL (0–100 => 0–254)
 ###############################################################################
-def set_hue_lights(room_name, new_state):
-    all_rooms = load_rooms_from_db()
-    if room_name not in all_rooms:
-        append_log(f"[WARN] set_hue_lights => no such room '{room_name}'")
+def set_hue_lights(room_name, new_state, rinfo=None, t0=None):
+    if rinfo is None:
+        rinfo = get_room(room_name)
+    if rinfo is None:
+        append_log("set_hue_lights => no such room '{room}'", "WARN", "hue", room=room_name)
         return
     
-    rinfo = all_rooms[room_name]
     ip  = rinfo["hue_bridge_ip"]
     usr = rinfo["hue_user"]
     lids= rinfo["light_ids"]
     if not ip or not usr or not lids:
-        append_log(f"[WARN] incomplete Hue => room='{room_name}', ip={ip}, user={usr}, lids={lids}")
+        append_log("incomplete Hue => room='{room}', ip={ip}, user={user}, lids={lids}",
+                   "WARN", "hue", room=room_name, ip=ip, user=usr, lids=lids)
         return
     
-    p_bri = rinfo["playing_bri"]
-    pa_bri= rinfo["paused_bri"]
-    s_bri = rinfo["stopped_bri"]
-    
     def pct_to_254(x):
         return int(round((x / 100) * 254))
     
+    # Brightness (and colour temperature) for this time of day, precompiled
+    final_pct, ct = room_target(rinfo, new_state)
     if new_state == "playing":
-        final_pct = p_bri
+        fade_ms = rinfo["playing_fade_ms"]
     elif new_state == "paused":
-        final_pct = pa_bri
+        fade_ms = rinfo["paused_fade_ms"]
     else:
-        final_pct = s_bri
+        fade_ms = rinfo["stopped_fade_ms"]
+    # Hue fades natively; transitiontime is in 100 ms steps
+    tt = None if fade_ms is None else min(int(round(fade_ms / 100)), 65535)
     
     final_bri = pct_to_254(final_pct)
+    if final_bri <= 0:
+        body = {"on": False}
+    else:
+        body = {"on": True, "bri": final_bri}
+        if ct is not None:
+            body["ct"] = ct
+
+    applied = {"state": new_state, "on": body["on"], "bri": final_pct if body["on"] else 0}
+
+    streamer = None
+    if rinfo.get("stream_area"):
+        streamer = get_light_streamer(ip, usr, rinfo["stream_area"])
+    if streamer is not None:
+        if t0 is None:
+            t0 = time.monotonic()
+        streamer.set_target(lids, final_bri / 254, (fade_ms or 0) / 1000)
+        remember_light_states(ip, lids, body)
+        latency = time.monotonic() - t0
+        m_event_to_light.observe(latency, room_name, ip)
+        publish_status("room", room=room_name, **applied)
+        record_light_state(room_name, rinfo.get("apple_tv_id"), applied, latency)
+        append_log("Streaming Hue lights => room='{room}', state='{state}', "
+                   "final_bri={bri}, fade={fade}ms", category="hue", room=room_name,
+                   state=new_state, bri=final_bri, fade=fade_ms)
+        return
+
+    stale = [lid for lid in lids if light_needs_update(ip, lid, body)]
+    if not stale:
+        if room_status.get(room_name) != applied:
+            publish_status("room", room=room_name, **applied)
+        return
     
+    if t0 is None:
+        t0 = time.monotonic()
     try:
-        b = Bridge(ip, username=usr)
-        b.connect()
-        
-        for lid in lids:
-            if final_bri <= 0:
-                b.set_light(lid, "on", False)
-            else:
-                b.set_light(lid, "on", True)
-                b.set_light(lid, "bri", final_bri)
+        b = get_hue_client(ip, usr)
+
+        # One group action when several lights need changing; otherwise (or
+        # if the group can't be used) one combined state PUT per stale light.
+        gid = ensure_room_group(b, room_name, rinfo) if len(stale) > 1 else None
+        group_ok = False
+        if gid is not None:
+            t = time.monotonic()
+            group_ok = hue_ok(b.set_group(gid, dict(body), transitiontime=tt))
+            m_hue_command.observe(time.monotonic() - t, ip, "group")
+        if group_ok:
+            remember_light_states(ip, lids, body)
+        else:
+            if gid is not None:
+                room_groups_synced.pop(room_name, None)
+            for lid in stale:
+                t = time.monotonic()
+                ok = hue_ok(b.set_light(lid, dict(body), transitiontime=tt))
+                m_hue_command.observe(time.monotonic() - t, ip, "light")
+                if ok:
+                    remember_light_states(ip, [lid], body)
+                else:
+                    forget_light_states(ip, [lid])
+        latency = time.monotonic() - t0
+        m_event_to_light.observe(latency, room_name, ip)
+        publish_status("room", room=room_name, **applied)
+        record_light_state(room_name, rinfo.get("apple_tv_id"), applied, latency)
         
         append_log(
-            f"Setting Hue lights => room='{room_name}', state='{new_state}', "
-            f"final_bri={final_bri} (userRequested={final_pct}%)"
+            "Setting Hue lights => room='{room}', state='{state}', "
+            "final_bri={bri} (userRequested={pct}%), ct={ct}, fade={fade}ms",
+            category="hue", room=room_name, state=new_state,
+            bri=final_bri, pct=final_pct, ct=ct, fade=fade_ms
         )
     except Exception as ex:
-        append_log(f"[ERROR] set_hue_lights => {ex}")
+        append_log("set_hue_lights => {ex}", "ERROR", "hue", room=room_name, ex=ex)
         traceback.print_exc()
+        forget_light_states(ip, lids)
+        drop_hue_clients(ip, usr)
+
+###############################################################################
+# LIGHT ACTUATION QUEUE (keeps bridge I/O off the asyncio loop)
+###############################################################################
+# Bursts of play/pause (scrubbing, ad skips) are coalesced per room: each new
+# event replaces the room's pending target and restarts its settle timer, and
+# only the latest target is sent once the room has been quiet for SETTLE_SEC.
+# Each bridge has its own worker pool (and rate limiter, see bridge_limiter),
+# so a saturated bridge only delays the rooms on that bridge.
+bridge_executors = {}   # bridge ip => ThreadPoolExecutor
+bridge_executors_lock = threading.Lock()
+
+def bridge_executor(ip):
+    with bridge_executors_lock:
+        ex = bridge_executors.get(ip)
+        if ex is None:
+            ex = bridge_executors[ip] = ThreadPoolExecutor(
+                max_workers=HUE_WORKERS, thread_name_prefix=f"hue-{ip}")
+    return ex
+
+room_pending = {}       # room_name => (new_state, rinfo, due monotonic time)
+room_running = set()    # rooms with a worker currently talking to the bridge
+room_timers = {}        # room_name => asyncio TimerHandle (loop thread only)
+room_queues_lock = threading.Lock()
+# asyncio may run timers up to its clock resolution early (~15.6 ms on Windows);
+# targets due within this much are sent rather than left for another timer
+SETTLE_SLACK_SEC = 0.02
+
+def queue_hue_lights(room_name, new_state, rinfo=None, t0=None):
+    """Schedule set_hue_lights and return immediately.
+
+    Superseded targets for a room are dropped; one worker at a time applies
+    a room's latest target while different rooms proceed in parallel.
+    t0 is the monotonic time of the triggering event, for latency metrics.
+    """
+    now = time.monotonic()
+    with room_queues_lock:
+        room_pending[room_name] = (new_state, rinfo, now + SETTLE_SEC, t0 or now)
+    if SETTLE_SEC <= 0:
+        _dispatch_room(room_name)
+    else:
+        loop.call_soon_threadsafe(_restart_room_timer, room_name)
+
+def _restart_room_timer(room_name):
+    """(Re)arm the room's timer for its pending target's due time."""
+    handle = room_timers.pop(room_name, None)
+    if handle is not None:
+        handle.cancel()
+    with room_queues_lock:
+        pending = room_pending.get(room_name)
+    if pending is None:
+        return
+    delay = max(0.0, pending[2] - time.monotonic())
+    room_timers[room_name] = loop.call_later(delay, _dispatch_room, room_name)
+
+def _dispatch_room(room_name):
+    room_timers.pop(room_name, None)
+    with room_queues_lock:
+        pending = room_pending.get(room_name)
+        if room_name in room_running or pending is None:
+            return
+        room_running.add(room_name)
+    rinfo = pending[1] or get_room(room_name) or {}
+    bridge_executor(rinfo.get("hue_bridge_ip")).submit(_run_room, room_name)
+
+def _run_room(room_name):
+    while True:
+        with room_queues_lock:
+            pending = room_pending.get(room_name)
+            if pending is None:
+                room_running.discard(room_name)
+                return
+            # Targets still inside their settle window go back to the timer,
+            # which is re-armed here since it may already have fired early
+            if pending[2] - time.monotonic() > SETTLE_SLACK_SEC:
+                room_running.discard(room_name)
+                loop.call_soon_threadsafe(_restart_room_timer, room_name)
+                return
+            del room_pending[room_name]
+        new_state, rinfo, _, t0 = pending
+        m_queue_wait.observe(time.monotonic() - t0, room_name)
+        try:
+            set_hue_lights(room_name, new_state, rinfo, t0)
+        except Exception as ex:
+            append_log("hue worker => room='{room}', ex={ex}", "ERROR", "hue",
+                       room=room_name, ex=ex)
+            traceback.print_exc()
+
+###############################################################################
+# APPLE TV DISCOVERY (batched scans, results cached per host)
+###############################################################################
+# Requests arriving within SCAN_BATCH_SEC of each other (e.g. every monitor
+# reconnecting after a network blip) share a single pyatv.scan over all of
+# their hosts. Everything here runs on the asyncio loop.
+SCAN_BATCH_SEC = 0.2
+scan_cache = {}         # host => (pyatv config, monotonic time scanned)
+scan_waiters = {}       # host => Future resolved by the next batched scan
+scan_task = None
+
+async def discover_apple_tv(host):
+    """Return the pyatv config for `host` (None if not found), scanning only on a cache miss."""
+    global scan_task
+    hit = scan_cache.get(host)
+    if hit and time.monotonic() - hit[1] < SCAN_CACHE_SEC:
+        return hit[0]
+    fut = scan_waiters.get(host)
+    if fut is None:
+        fut = scan_waiters[host] = loop.create_future()
+        if scan_task is None:
+            scan_task = loop.create_task(_run_batched_scan())
+    # shield: one caller giving up must not cancel the result for the others
+    return await asyncio.shield(fut)
+
+async def _run_batched_scan():
+    global scan_task
+    await asyncio.sleep(SCAN_BATCH_SEC)
+    waiters = dict(scan_waiters)
+    scan_waiters.clear()
+    scan_task = None
+    try:
+        import pyatv
+        results = await pyatv.scan(loop, hosts=list(waiters))
+    except Exception as ex:
+        for fut in waiters.values():
+            if not fut.done():
+                fut.set_exception(ex)
+        return
+    found = {str(c.address): c for c in results}
+    if len(waiters) == 1 and len(results) == 1:
+        found = {next(iter(waiters)): results[0]}   # host given as a name
+    now = time.monotonic()
+    for host, fut in waiters.items():
+        c = found.get(host)
+        if c is not None:
+            scan_cache[host] = (c, now)
+        if not fut.done():
+            fut.set_result(c)
+
+def forget_apple_tv(host):
+    """Drop a cached scan result, e.g. after connecting with it failed."""
+    scan_cache.pop(host, None)
 
 ###############################################################################
 # APPLE TV MONITOR
 ###############################################################################
 atv_connections = {}
 
-class RnRAppleTVListener(PushListener):
+class RnRAppleTVListener:
+    """pyatv PushListener (duck-typed, so pyatv needn't be loaded to define it)."""
+
     def __init__(self, atv_id):
-        super().__init__()
+        from pyatv.const import DeviceState
         self.atv_id = atv_id
+        self.devmap = {
+            DeviceState.Playing: "playing",
+            DeviceState.Paused:  "paused",
+            DeviceState.Stopped: "stopped",
+            DeviceState.Idle:    "stopped"
+        }
 
     def playstatus_update(self, updater, playstate):
         try:
-            devmap = {
-                DeviceState.Playing: "playing",
-                DeviceState.Paused:  "paused",
-                DeviceState.Stopped: "stopped",
-                DeviceState.Idle:    "stopped"
-            }
-            new_state = devmap.get(playstate.device_state, "stopped")
-            append_log(f"AppleTV atv_id='{self.atv_id}' => {new_state}")
+            t0 = time.monotonic()
+            new_state = self.devmap.get(playstate.device_state, "stopped")
+            append_log("AppleTV atv_id='{atv_id}' => {state}", category="atv",
+                       atv_id=self.atv_id, state=new_state)
+            publish_status("atv", atv_id=self.atv_id, state=new_state)
+            record_play_state(self.atv_id, new_state)
 
             # For each room referencing this atv_id
-            rdict = load_rooms_from_db()
-            for rnm, rcfg in rdict.items():
-                if rcfg["apple_tv_id"] == self.atv_id:
-                    set_hue_lights(rnm, new_state)
+            for rnm, rcfg in rooms_for_atv(self.atv_id):
+                queue_hue_lights(rnm, new_state, rcfg, t0)
+            m_event_dispatch.observe(time.monotonic() - t0, self.atv_id)
         except Exception as e:
-            append_log(f"[ERROR] playstatus_update => {e}")
+            append_log("playstatus_update => {ex}", "ERROR", "atv", atv_id=self.atv_id, ex=e)
             traceback.print_exc()
 
     def playstatus_error(self, updater, exception):
-        append_log(f"[ERROR] push error => {self.atv_id}, ex={exception}")
+        append_log("push error => {atv_id}, ex={ex}", "ERROR", "atv",
+                   atv_id=self.atv_id, ex=exception)
         traceback.print_exc()
 
+class RnRDeviceListener:
+    """pyatv DeviceListener: wakes the monitor as soon as the connection is gone."""
+
+    def __init__(self, lost):
+        self.lost = lost
+
+    def connection_lost(self, exception):
+        self.lost.set()
+
+    def connection_closed(self):
+        self.lost.set()
+
+def _close_atv(atv_id):
+    atv = atv_connections.pop(atv_id, None)
+    if atv is not None:
+        try:
+            atv.push_updater.stop()
+            atv.close()
+        except Exception:
+            pass
+
+def reconnect_delay(attempts):
+    """Exponential backoff with jitter: half fixed, half random."""
+    cap = min(RECONNECT_MAX_SEC, RECONNECT_MIN_SEC * (2 ** (attempts - 1)))
+    return cap / 2 + random.uniform(0, cap / 2)
+
 async def monitor_apple_tv(atv_id):
+    """Keep one Apple TV connected; only ever run via ensure_monitor()."""
+    attempts = 0
     while True:
+        lost = asyncio.Event()
         try:
-            conn = get_connection()
-            c = conn.cursor()
-            c.execute("SELECT host, credentials FROM apple_tvs WHERE atv_id=?", (atv_id,))
-            row = c.fetchone()
-            conn.close()
+            publish_status("atv", atv_id=atv_id, monitor="connecting", attempts=attempts)
+            with db_cursor() as c:
+                c.execute("SELECT host, credentials FROM apple_tvs WHERE atv_id=?", (atv_id,))
+                row = c.fetchone()
             if not row:
                 raise Exception(f"No AppleTV => id={atv_id} in DB.")
             (host, creds) = row
             if not host:
                 raise Exception(f"No host for AppleTV => id={atv_id}")
 
-            append_log(f"Connecting to AppleTV => id={atv_id}, host={host}")
-            sr = await pyatv.scan(loop, hosts=[host])
-            if not sr:
+            append_log("Connecting to AppleTV => id={atv_id}, host={host}", category="atv",
+                       atv_id=atv_id, host=host)
+            conf = await discover_apple_tv(host)
+            if conf is None:
                 raise Exception(f"No AppleTV discovered => host={host}")
-            conf = sr[0]
+            import pyatv
             conf.set_credentials(pyatv.Protocol.AirPlay, creds or "")
-            atv = await pyatv.connect(conf, loop)
-            update_apple_tv_connected(atv_id, True)
+            try:
+                atv = await pyatv.connect(conf, loop)
+            except Exception:
+                forget_apple_tv(host)
+                raise
             atv_connections[atv_id] = atv
 
-            listener = RnRAppleTVListener(atv_id)
-            atv.push_updater.listener = listener
+            # pyatv only keeps weak references to listeners; these locals keep
+            # them alive for as long as this coroutine waits on the connection
+            device_listener = RnRDeviceListener(lost)
+            push_listener = RnRAppleTVListener(atv_id)
+            atv.listener = device_listener
+            atv.push_updater.listener = push_listener
             atv.push_updater.start()
-
-            while True:
-                await asyncio.sleep(10)
-
-        except Exception as ex:
-            append_log(f"[ERROR] monitor_apple_tv => atv_id={atv_id}, ex={ex}")
+            update_apple_tv_connected(atv_id, True)
+            attempts = 0
+            publish_status("atv", atv_id=atv_id, monitor="connected", attempts=0,
+                           retry_in=None, last_error=None)
+
+            await lost.wait()
+            err = "connection lost"
+        except asyncio.CancelledError:
+            _close_atv(atv_id)
             update_apple_tv_connected(atv_id, False)
-            await asyncio.sleep(5)
-        finally:
-            if atv_id in atv_connections:
-                try:
-                    atv_connections[atv_id].push_updater.stop()
-                    atv_connections[atv_id].close()
-                except:
-                    pass
-                del atv_connections[atv_id]
+            publish_status("atv", atv_id=atv_id, monitor="stopped")
+            raise
+        except Exception as ex:
+            err = ex
+        _close_atv(atv_id)
+
+        attempts += 1
+        delay = reconnect_delay(attempts)
+        append_log("monitor_apple_tv => atv_id={atv_id}, ex={ex}, "
+                   "retry in {delay:.1f}s (attempt {attempts})", "ERROR", "atv",
+                   atv_id=atv_id, ex=err, delay=delay, attempts=attempts)
+        update_apple_tv_connected(atv_id, False)
+        publish_status("atv", atv_id=atv_id, monitor="backoff", attempts=attempts,
+                       retry_in=round(delay, 1), last_error=str(err))
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            publish_status("atv", atv_id=atv_id, monitor="stopped")
+            raise
+
+###############################################################################
+# APPLE TV SUPERVISOR (exactly one monitor task per Apple TV)
+###############################################################################
+monitor_tasks = {}      # atv_id => asyncio.Task (loop thread only)
+
+def ensure_monitor(atv_id, restart=False):
+    """Start the monitor for atv_id unless one is running; restart=True replaces it.
+
+    Must run on the loop thread (or before the loop starts).
+    """
+    task = monitor_tasks.get(atv_id)
+    if task is not None and not task.done():
+        if not restart:
+            return
+        task.cancel()
+    monitor_tasks[atv_id] = loop.create_task(monitor_apple_tv(atv_id))
+
+def stop_monitor(atv_id):
+    """Cancel the monitor for atv_id (it closes its connection). Loop thread only."""
+    task = monitor_tasks.pop(atv_id, None)
+    if task is not None:
+        task.cancel()
 
 ###############################################################################
 # BACKGROUND EVENT LOOP
@@ -404,6 +2160,8 @@ def api_hue_pair():
     ip = data.get("bridge_ip")
     if not ip:
         return jsonify({"error": "bridge_ip required"}), 400
+    if data.get("entertainment"):
+        return pair_entertainment_bridge(ip)
     try:
         b = Bridge(ip)
         user = None
@@ -412,7 +2170,7 @@ def api_hue_pair():
             if tmp_user:
                 user = tmp_user
         except Exception as e:
-            append_log(f"[WARN] hue register_app => {e}")
+            append_log("hue register_app => {ex}", "WARN", "hue", ex=e)
         b.connect()
         if user is None:
             user = b.username
@@ -420,45 +2178,180 @@ def api_hue_pair():
             return jsonify({"error": "No user. Did you press link button?"}), 400
 
         save_hue_bridge_db(ip, user)
-        append_log(f"Hue Bridge => ip={ip}, user={user}")
+        append_log("Hue Bridge => ip={ip}, user={user}", category="hue", ip=ip, user=user)
         return jsonify({"status": "hue_paired", "hue_user": user})
     except Exception as ex:
-        append_log(f"[ERROR] hue_pair => {ex}")
+        append_log("hue_pair => {ex}", "ERROR", "hue", ex=ex)
+        traceback.print_exc()
+        return jsonify({"error": str(ex)}), 500
+
+def pair_entertainment_bridge(ip):
+    """Register with generateclientkey, which streaming (DTLS PSK) needs."""
+    try:
+        conn = http.client.HTTPConnection(ip, timeout=10)
+        conn.request("POST", "/api", json.dumps(
+            {"devicetype": "rnr_automation#entertainment", "generateclientkey": True}))
+        resp = json.loads(conn.getresponse().read().decode("utf-8"))
+        conn.close()
+        ok = resp[0].get("success") if isinstance(resp, list) and resp else None
+        if not ok:
+            err = resp[0].get("error", {}) if isinstance(resp, list) and resp else {}
+            return jsonify({"error": err.get("description") or "No user. Did you press link button?"}), 400
+        save_hue_bridge_db(ip, ok["username"], clientkey=ok.get("clientkey"))
+        return jsonify({"status": "hue_paired", "hue_user": ok["username"], "entertainment": True})
+    except Exception as ex:
+        append_log("hue_pair => {ex}", "ERROR", "hue", ex=ex)
         traceback.print_exc()
         return jsonify({"error": str(ex)}), 500
 
 @app.route("/api/hue/status", methods=["GET"])
 def api_hue_status():
-    hb = load_hue_bridge()
-    if not hb:
+    """The default bridge, plus every paired bridge under "bridges"."""
+    def build():
+        bridges = load_hue_bridges()
+        if not bridges:
+            return None
+        hb = bridges[0]
+        return {"bridge_ip": hb["ip"], "hue_user": hb["user"],
+                "bridges": [public_bridge(b) for b in bridges]}
+
+    resp = cached_json_response("hue_status", build)
+    if resp is None:
         return jsonify({"error": "No HueBridge in DB"}), 404
-    return jsonify({"bridge_ip": hb["ip"], "hue_user": hb["user"]})
+    return resp
+
+@app.route("/api/hue/bridges", methods=["GET"])
+def api_hue_bridges():
+    """Return [{ip, user, name, rooms: [...]}, ...], default bridge first."""
+    by_ip = {}
+    for rn, rcfg in rooms_by_name.items():
+        by_ip.setdefault(rcfg["hue_bridge_ip"], []).append(rn)
+    return jsonify([dict(public_bridge(hb), rooms=sorted(by_ip.get(hb["ip"], [])))
+                    for hb in load_hue_bridges()])
+
+@app.route("/api/hue/bridges/<ip>", methods=["DELETE"])
+def api_delete_hue_bridge(ip):
+    in_use = sorted(rn for rn, rcfg in rooms_by_name.items() if rcfg["hue_bridge_ip"] == ip)
+    if in_use:
+        return jsonify({"error": "Bridge is used by rooms", "rooms": in_use}), 409
+    if delete_hue_bridge_db(ip) > 0:
+        append_log("Hue Bridge => removed ip={ip}", category="hue", ip=ip)
+        return jsonify({"status": "bridge_deleted", "bridge_ip": ip})
+    return jsonify({"error": "Bridge not found"}), 404
 
 @app.route("/api/hue/lights", methods=["GET"])
 def api_hue_lights():
-    hb = load_hue_bridge()
+    """Return { lightId: name } from the cached inventory.
+
+    ?bridge_ip= picks the bridge (default: the first paired),
+    ?detail=1 returns full records (name, type, reachable, on, bri) and
+    ?refresh=1 forces a bridge fetch. Responses carry an ETag for
+    If-None-Match; X-Inventory-Stale: 1 means the bridge could not be
+    reached and the last known inventory is being served.
+    """
+    hb = load_hue_bridge(request.args.get("bridge_ip") or None)
     if not hb:
         return jsonify({})
-    try:
-        b = Bridge(hb["ip"], hb["user"])
-        b.connect()
-        all_lights = b.get_light_objects("id")
-        out = {}
-        for lid, obj in all_lights.items():
-            out[str(lid)] = obj.name
-        return jsonify(out)
-    except Exception as ex:
-        append_log(f"[ERROR] hue_lights => {ex}")
-        traceback.print_exc()
-        return jsonify({"error": str(ex)}), 500
+    ip, user = hb["ip"], hb["user"]
+    inv = hue_inventory.get(ip)
+    if inv is None or request.args.get("refresh") == "1":
+        try:
+            inv = refresh_hue_inventory(ip, user)
+        except Exception as ex:
+            append_log("hue_lights => {ex}", "ERROR", "hue", ex=ex)
+            traceback.print_exc()
+            inv = hue_inventory.get(ip)
+            if inv is None:
+                return jsonify({"error": str(ex)}), 500
+    elif LIGHT_REFRESH_SEC > 0 and time.monotonic() - inv["fetched"] > LIGHT_REFRESH_SEC:
+        schedule_inventory_refresh(ip, user)
+
+    detail = request.args.get("detail") == "1"
+    if detail:
+        out = inv["lights"]
+    else:
+        out = {lid: light["name"] for lid, light in inv["lights"].items()}
+    resp = jsonify(out)
+    resp.set_etag(inv["etag"] + ("-detail" if detail else ""))
+    resp.headers["X-Inventory-Age"] = str(int(time.monotonic() - inv["fetched"]))
+    if inv["stale"]:
+        resp.headers["X-Inventory-Stale"] = "1"
+    return resp.make_conditional(request)
 
 ###############################################################################
 # APPLE TV PAIRING
 ###############################################################################
-pairing_sessions = {}
+# Pairing runs as background jobs on the asyncio loop: the API returns a
+# job id at once and clients poll /api/pairing/<job_id> (or watch
+# /api/status/stream for "pairing" events). Each step has a timeout, and
+# sessions left waiting for a PIN are closed after PAIRING_TTL_SEC.
+MAX_PAIRING_SESSIONS = 16
+pairing_sessions = {}   # atv_id => {"pairing", "host", "name", "job_id", "touched"}
+pairing_jobs = {}       # job_id => {"job_id", "atv_id", "state", "error", "created", "updated"}
+pairing_lock = threading.Lock()
+
+def update_pairing_job(job_id, **fields):
+    with pairing_lock:
+        job = pairing_jobs.get(job_id)
+        if job is None:
+            return
+        job.update(fields, updated=time.time())
+        snapshot = dict(job)
+    publish_status("pairing", **snapshot)
+
+def end_pairing_session(atv_id, job_id=None):
+    """Forget atv_id's session (only if it still belongs to job_id) and close it."""
+    with pairing_lock:
+        session = pairing_sessions.get(atv_id)
+        if session is None or (job_id is not None and session["job_id"] != job_id):
+            return
+        del pairing_sessions[atv_id]
+    if session["pairing"] is not None:
+        asyncio.run_coroutine_threadsafe(session["pairing"].close(), loop)
+
+def evict_pairing_sessions():
+    """Close sessions idle past PAIRING_TTL_SEC and drop old job records."""
+    now = time.monotonic()
+    with pairing_lock:
+        idle = [(aid, s["job_id"]) for aid, s in pairing_sessions.items()
+                if now - s["touched"] > PAIRING_TTL_SEC]
+    for atv_id, job_id in idle:
+        end_pairing_session(atv_id, job_id)
+        update_pairing_job(job_id, state="expired", error="pairing session expired")
+        append_log("Pairing => expired, id={atv_id}", "WARN", "pair", atv_id=atv_id)
+    # Finished jobs stay readable for another TTL after their last change
+    wall = time.time()
+    with pairing_lock:
+        for jid in [jid for jid, job in pairing_jobs.items()
+                    if wall - job["updated"] > PAIRING_TTL_SEC]:
+            del pairing_jobs[jid]
+
+def run_pairing_step(job_id, atv_id, coro):
+    """Run one pairing coroutine on the loop with a timeout; returns immediately.
+
+    The coroutine's return value becomes the job state; failures end the session.
+    """
+    async def step():
+        try:
+            state = await asyncio.wait_for(coro, PAIRING_TIMEOUT_SEC)
+        except Exception as ex:
+            if isinstance(ex, asyncio.TimeoutError):
+                ex = f"timed out after {PAIRING_TIMEOUT_SEC:g}s"
+            append_log("pairing => {ex}", "ERROR", "pair", atv_id=atv_id, ex=ex)
+            end_pairing_session(atv_id, job_id)
+            update_pairing_job(job_id, state="failed", error=str(ex))
+        else:
+            update_pairing_job(job_id, state=state)
+
+    asyncio.run_coroutine_threadsafe(step(), loop)
 
 @app.route("/api/start_pairing", methods=["POST"])
 def start_pairing():
+    """Begin pairing; returns {"job_id"} while the Apple TV is contacted.
+
+    The job moves from "starting" to "waiting_pin" (PIN shown on the TV)
+    or "failed".
+    """
     data = request.json
     if not data:
         return jsonify({"error": "No JSON"}), 400
@@ -470,36 +2363,57 @@ def start_pairing():
     if not atv_id or not atv_name or not host:
         return jsonify({"error": "apple_tv_id, apple_tv_name, ip_address required"}), 400
 
+    evict_pairing_sessions()
+    end_pairing_session(atv_id)     # starting over replaces any earlier attempt
+    job_id = uuid.uuid4().hex
+    with pairing_lock:
+        if len(pairing_sessions) >= MAX_PAIRING_SESSIONS:
+            return jsonify({"error": "Too many pairing sessions in progress"}), 429
+        pairing_jobs[job_id] = {"job_id": job_id, "atv_id": atv_id, "state": "starting",
+                                "error": None, "created": time.time(), "updated": time.time()}
+        pairing_sessions[atv_id] = {"pairing": None, "host": host, "name": atv_name,
+                                    "job_id": job_id, "touched": time.monotonic()}
+
     async def do_start():
-        scan_res = await pyatv.scan(loop, hosts=[host])
-        if not scan_res:
+        conf = await discover_apple_tv(host)
+        if conf is None:
             raise Exception(f"No AppleTV at {host}")
-        conf = scan_res[0]
+        import pyatv
         try:
             p = getattr(pyatv.Protocol, protocol.capitalize())
         except AttributeError:
             p = pyatv.Protocol.AirPlay
         pair_obj = await pyatv.pair(conf, p, loop=loop)
-        pairing_sessions[atv_id] = {
-            "pairing": pair_obj,
-            "host": host,
-            "name": atv_name
-        }
+        with pairing_lock:
+            session = pairing_sessions.get(atv_id)
+            current = session is not None and session["job_id"] == job_id
+            if current:
+                session["pairing"] = pair_obj
+        if not current:
+            await pair_obj.close()
+            raise Exception("pairing session was replaced")
         await pair_obj.begin()
+        return "waiting_pin"
 
     try:
         save_apple_tv(atv_id, atv_name, host, creds="")
-        fut = asyncio.run_coroutine_threadsafe(do_start(), loop)
-        fut.result()
-        append_log(f"start_pairing => ID={atv_id}, name={atv_name}, ip={host}")
-        return jsonify({"status": "pairing_started"})
     except Exception as ex:
-        append_log(f"[ERROR] start_pairing => {ex}")
+        end_pairing_session(atv_id, job_id)
+        update_pairing_job(job_id, state="failed", error=str(ex))
+        append_log("start_pairing => {ex}", "ERROR", "pair", atv_id=atv_id, ex=ex)
         traceback.print_exc()
         return jsonify({"error": str(ex)}), 500
+    # The old credentials are gone; don't let the monitor keep retrying with none.
+    # do_finish() starts it again once pairing succeeds.
+    loop.call_soon_threadsafe(stop_monitor, atv_id)
+    run_pairing_step(job_id, atv_id, do_start())
+    append_log("start_pairing => ID={atv_id}, name={name}, ip={host}", category="pair",
+               atv_id=atv_id, name=atv_name, host=host)
+    return jsonify({"status": "pairing_started", "job_id": job_id}), 202
 
 @app.route("/api/enter_pin", methods=["POST"])
 def enter_pin():
+    """Submit the PIN; the job moves to "finishing", then "paired" or "failed"."""
     data = request.json
     if not data:
         return jsonify({"error": "No JSON"}), 400
@@ -508,43 +2422,58 @@ def enter_pin():
     if not atv_id or not pin:
         return jsonify({"error": "Missing atv_id or pin"}), 400
 
-    if atv_id not in pairing_sessions:
-        return jsonify({"error": "No active pairing session for that atv_id"}), 400
-
-    pairing_info = pairing_sessions[atv_id]
-    pairing_obj  = pairing_info["pairing"]
-    host         = pairing_info["host"]
-    friendlyName = pairing_info["name"]
+    evict_pairing_sessions()
+    with pairing_lock:
+        session = pairing_sessions.get(atv_id)
+        job = pairing_jobs.get(session["job_id"]) if session else None
+        if job is None:
+            return jsonify({"error": "No active pairing session for that atv_id"}), 400
+        job_id = job["job_id"]
+        if job["state"] != "waiting_pin":
+            return jsonify({"error": f"Pairing is {job['state']}", "job_id": job_id}), 409
+        session["touched"] = time.monotonic()
+        pairing_obj  = session["pairing"]
+        host         = session["host"]
+        friendlyName = session["name"]
+    update_pairing_job(job_id, state="finishing")
 
     async def do_finish():
         pairing_obj.pin(pin)
         await pairing_obj.finish()
-        if pairing_obj.has_paired:
-            cred = pairing_obj.service.credentials
-            save_apple_tv(atv_id, friendlyName, host, cred)
-            append_log(f"Pairing => finished, id={atv_id}, name={friendlyName}")
-            loop.create_task(monitor_apple_tv(atv_id))
-            return "pairing_finished"
-        else:
-            return "pairing_failed"
-
-    try:
-        fut = asyncio.run_coroutine_threadsafe(do_finish(), loop)
-        ret = fut.result()
-        if ret == "pairing_finished":
-            del pairing_sessions[atv_id]
-        return jsonify({"status": ret})
-    except Exception as ex:
-        append_log(f"[ERROR] enter_pin => {ex}")
-        return jsonify({"error": f"Pairing failed => {ex}"}), 500
+        if not pairing_obj.has_paired:
+            raise Exception("Apple TV rejected the PIN")
+        cred = pairing_obj.service.credentials
+        save_apple_tv(atv_id, friendlyName, host, cred)
+        append_log("Pairing => finished, id={atv_id}, name={name}", category="pair",
+                   atv_id=atv_id, name=friendlyName)
+        ensure_monitor(atv_id, restart=True)
+        end_pairing_session(atv_id, job_id)
+        return "paired"
+
+    run_pairing_step(job_id, atv_id, do_finish())
+    return jsonify({"status": "pin_submitted", "job_id": job_id}), 202
+
+@app.route("/api/pairing/<job_id>", methods=["GET"])
+def api_pairing_job(job_id):
+    """Pairing job state: starting, waiting_pin, finishing, paired, failed or expired."""
+    evict_pairing_sessions()
+    with pairing_lock:
+        job = pairing_jobs.get(job_id)
+        job = dict(job) if job else None
+    if job is None:
+        return jsonify({"error": "Unknown or expired job_id"}), 404
+    return jsonify(job)
 
 @app.route("/api/apple_tvs", methods=["GET"])
 def api_list_apple_tvs():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT atv_id, atv_name, host, credentials, is_connected FROM apple_tvs WHERE credentials<>''")
-    rows = c.fetchall()
-    conn.close()
+    return cached_json_response("apple_tvs", load_apple_tvs)
+
+def load_apple_tvs():
+    """Paired Apple TVs as { name: {apple_tv_id, ip, connected} }."""
+    connected_writer.flush()
+    with db_cursor() as c:
+        c.execute("SELECT atv_id, atv_name, host, credentials, is_connected FROM apple_tvs WHERE credentials<>''")
+        rows = c.fetchall()
 
     out = {}
     for (aid, aname, h, creds, ic) in rows:
@@ -553,7 +2482,7 @@ def api_list_apple_tvs():
             "ip": h,
             "connected": bool(ic)
         }
-    return jsonify(out)
+    return out
 
 ###############################################################################
 # ROOMS
@@ -561,56 +2490,241 @@ def api_list_apple_tvs():
 @app.route("/api/rooms", methods=["GET"])
 def api_list_rooms():
     """Return user-defined rooms as { roomName: {...} }, brightness in 0–100."""
-    return jsonify(load_rooms_from_db())
+    return cached_json_response("rooms", load_rooms_from_db)
+
+ROOM_DEFAULTS = {
+    "apple_tv_id": "",
+    "light_ids": [],
+    "playing_bri": 60,
+    "paused_bri": 80,
+    "stopped_bri": 100,
+    "playing_fade_ms": 400,
+    "paused_fade_ms": 400,
+    "stopped_fade_ms": 400,
+    "stream_area": None,
+    "profile": []
+}
+AUTOMATION_FIELDS = ("playing_bri", "paused_bri", "stopped_bri",
+                     "playing_fade_ms", "paused_fade_ms", "stopped_fade_ms")
+
+def room_from_json(data, base=None, bridges=None):
+    """Validate a room definition and return save_room_db keyword arguments.
+
+    Fields missing from `data` come from `base` (an existing room config) or
+    ROOM_DEFAULTS. `bridges` maps ip => bridge record, default bridge first.
+    Raises ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("room must be an object")
+    room_name = data.get("room_name")
+    if not room_name or not isinstance(room_name, str):
+        raise ValueError("room_name required")
+    base = base or {}
+    if bridges is None:
+        bridges = {hb["ip"]: hb for hb in load_hue_bridges()}
+
+    def pick(key):
+        return data[key] if key in data else base.get(key, ROOM_DEFAULTS[key])
+
+    out = {"room_name": room_name, "atv_id": pick("apple_tv_id") or ""}
+    lids = pick("light_ids")
+    if not isinstance(lids, list):
+        raise ValueError("light_ids must be a list")
+    out["light_ids"] = lids
+    for key in AUTOMATION_FIELDS:
+        try:
+            out[key] = int(pick(key))
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} must be an integer")
+        if key.endswith("_bri") and not 0 <= out[key] <= 100:
+            raise ValueError(f"{key} must be 0–100")
+        # Hue's transitiontime tops out at 65535 (x 100 ms)
+        if key.endswith("_fade_ms") and not 0 <= out[key] <= 6553500:
+            raise ValueError(f"{key} must be 0–6553500")
+    out["stream_area"] = pick("stream_area") or None
+    out["profile"] = parse_profile(pick("profile"))
+
+    # Rooms are bound to one bridge; default to the first one paired
+    ip = data.get("hue_bridge_ip")
+    if ip:
+        if ip not in bridges:
+            raise ValueError(f"unknown hue_bridge_ip {ip}")
+        hb = bridges[ip]
+    elif base.get("hue_bridge_ip"):
+        hb = bridges.get(base["hue_bridge_ip"],
+                         {"ip": base["hue_bridge_ip"], "user": base.get("hue_user")})
+    else:
+        hb = next(iter(bridges.values()), {"ip": "", "user": ""})
+    out["hue_bridge_ip"] = hb["ip"]
+    out["hue_user"] = hb["user"]
+    return out
+
+def parse_room_batch(rooms, bridges):
+    """Return ([save_room_db kwargs, ...], [error, ...]) for a list of rooms."""
+    defs, errors = [], []
+    for i, data in enumerate(rooms):
+        try:
+            base = get_room(data.get("room_name")) if isinstance(data, dict) else None
+            defs.append(room_from_json(data, base, bridges))
+        except ValueError as ex:
+            errors.append(f"rooms[{i}]: {ex}")
+    return defs, errors
+
+def forget_room(room_name, rinfo):
+    """Clean up after a deleted room: bridge group, stream and live status."""
+    bridge_executor(rinfo["hue_bridge_ip"]).submit(delete_room_group, room_name, rinfo)
+    if rinfo.get("stream_area"):
+        stop_light_streamer(rinfo["hue_bridge_ip"])
+    with status_events.cond:
+        room_status.pop(room_name, None)
+
+def apply_room_batch(defs, delete=()):
+    """Save and delete rooms in one transaction; the index is swapped once."""
+    removed = {rn: get_room(rn) for rn in delete if get_room(rn) is not None}
+    def cleanup():
+        for rn, rinfo in removed.items():
+            forget_room(rn, rinfo)
+
+    with db_cursor():
+        for d in defs:
+            save_room_db(**d)
+        for rn in removed:
+            delete_room_db(rn)
+        after_commit(cleanup)
+    return {"saved": len(defs), "deleted": len(removed)}
 
 @app.route("/api/rooms", methods=["POST"])
 def add_room():
-    data = request.json
-    room_name = data["room_name"]
-    atv_id    = data.get("apple_tv_id", "")
-    lids      = data.get("light_ids", [])
-
-    p_bri = int(data.get("playing_bri", 60))
-    pa_bri= int(data.get("paused_bri", 80))
-    s_bri = int(data.get("stopped_bri", 100))
-
-    hb = load_hue_bridge()
-    ip_  = hb["ip"]  if hb else ""
-    usr_ = hb["user"] if hb else ""
-
-    save_room_db(room_name, atv_id, ip_, usr_, lids, p_bri, pa_bri, s_bri)
-    return jsonify({"status": "room_added", "room_name": room_name})
+    try:
+        d = room_from_json(request.json)
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    save_room_db(**d)
+    return jsonify({"status": "room_added", "room_name": d["room_name"]})
 
 @app.route("/api/rooms/<room_name>/automation", methods=["POST"])
 def update_room_automation(room_name):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT apple_tv_id, hue_bridge_ip, hue_user, light_ids
-        FROM rooms
-        WHERE room_name=?
-    """, (room_name,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    """Change brightness/fade/profile settings only; omitted fields keep their value."""
+    rinfo = get_room(room_name)
+    if rinfo is None:
         return jsonify({"error": "Room not found"}), 404
+    data = request.json or {}
+    fields = {k: data[k] for k in AUTOMATION_FIELDS + ("profile",) if k in data}
+    try:
+        d = room_from_json(dict(fields, room_name=room_name), rinfo)
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    save_room_db(**d)
+    return jsonify({"status": "automation_updated", "room": room_name})
 
-    (aid, hb_ip, hb_usr, lids_j) = row
-    lids = json.loads(lids_j) if lids_j else []
-
-    data  = request.json
-    p_bri = int(data.get("playing_bri", 60))
-    pa_bri= int(data.get("paused_bri", 80))
-    s_bri = int(data.get("stopped_bri", 100))
+@app.route("/api/rooms/bulk", methods=["POST"])
+def api_rooms_bulk():
+    """Create/update and delete many rooms in one transaction.
 
-    save_room_db(room_name, aid, hb_ip, hb_usr, lids, p_bri, pa_bri, s_bri)
-    return jsonify({"status": "automation_updated", "room": room_name})
+    Body: {"rooms": [room, ...], "delete": [room_name, ...]} (a bare list is
+    taken as "rooms"). Each room is merged onto the existing room of that
+    name. Nothing is applied if any entry is invalid.
+    """
+    data = request.json
+    if isinstance(data, list):
+        data = {"rooms": data}
+    if not isinstance(data, dict):
+        return jsonify({"error": "No JSON"}), 400
+    rooms, delete = data.get("rooms", []), data.get("delete", [])
+    if not isinstance(rooms, list) or not isinstance(delete, list):
+        return jsonify({"error": "rooms and delete must be lists"}), 400
+    defs, errors = parse_room_batch(rooms, {hb["ip"]: hb for hb in load_hue_bridges()})
+    if errors:
+        return jsonify({"error": "Invalid rooms", "details": errors}), 400
+    result = apply_room_batch(defs, [rn for rn in delete if isinstance(rn, str)])
+    append_log("Rooms bulk => saved={saved}, deleted={deleted}", category="room", **result)
+    return jsonify(dict(result, status="rooms_applied"))
+
+@app.route("/api/config/export", methods=["GET"])
+def api_export_config():
+    """Apple TVs, Hue bridges and rooms as one JSON document.
+
+    Includes pairing credentials and bridge keys; keep exports private.
+    """
+    with db_cursor() as c:
+        c.execute("SELECT atv_id, atv_name, host, credentials FROM apple_tvs")
+        atvs = [{"atv_id": aid, "atv_name": nm, "host": host, "credentials": creds}
+                for (aid, nm, host, creds) in c.fetchall()]
+        bridges = load_hue_bridges()
+        rooms = load_rooms_from_db()
+    resp = jsonify({
+        "version": 1,
+        "exported": time.time(),
+        "apple_tvs": atvs,
+        "hue_bridges": bridges,
+        "rooms": [dict({k: v for k, v in rcfg.items() if k not in ("hue_user", "hue_group_id")},
+                       room_name=rn) for rn, rcfg in rooms.items()]
+    })
+    resp.headers["Content-Disposition"] = "attachment; filename=rnr_config.json"
+    return resp
+
+@app.route("/api/config/import", methods=["POST"])
+def api_import_config():
+    """Load an export in one transaction; ?replace=1 also deletes rooms not in it."""
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "No JSON"}), 400
+    atvs = data.get("apple_tvs", [])
+    bridges = data.get("hue_bridges", [])
+    rooms = data.get("rooms", [])
+    if not all(isinstance(x, list) for x in (atvs, bridges, rooms)):
+        return jsonify({"error": "apple_tvs, hue_bridges and rooms must be lists"}), 400
+
+    errors = [f"apple_tvs[{i}]: atv_id required" for i, a in enumerate(atvs)
+              if not isinstance(a, dict) or not a.get("atv_id")]
+    errors += [f"hue_bridges[{i}]: ip and user required" for i, hb in enumerate(bridges)
+               if not isinstance(hb, dict) or not hb.get("ip") or not hb.get("user")]
+    known = {hb["ip"]: hb for hb in load_hue_bridges()}
+    known.update((hb["ip"], hb) for hb in bridges if isinstance(hb, dict) and hb.get("ip"))
+    defs, room_errors = parse_room_batch(rooms, known)
+    errors += room_errors
+    if errors:
+        return jsonify({"error": "Invalid config", "details": errors}), 400
+
+    delete = []
+    if request.args.get("replace") == "1":
+        keep = {d["room_name"] for d in defs}
+        delete = [rn for rn in rooms_by_name if rn not in keep]
+    with db_cursor() as c:
+        c.execute("SELECT atv_id, host, credentials FROM apple_tvs")
+        before = {aid: (host, creds) for (aid, host, creds) in c.fetchall()}
+    with db_cursor():
+        for hb in bridges:
+            save_hue_bridge_db(hb["ip"], hb["user"], hb.get("name"), hb.get("clientkey"))
+        for a in atvs:
+            save_apple_tv(a["atv_id"], a.get("atv_name") or a["atv_id"], a.get("host") or "",
+                          a.get("credentials") or "")
+        result = apply_room_batch(defs, delete)
+    # Only reconnect devices whose connection details changed; rooms are
+    # routed through the index, so a running monitor needs no restart for them
+    for a in atvs:
+        if a.get("credentials"):
+            changed = before.get(a["atv_id"]) != (a.get("host") or "", a["credentials"])
+            loop.call_soon_threadsafe(ensure_monitor, a["atv_id"], changed)
+    append_log("Config import => apple_tvs={atvs}, bridges={bridges}, rooms saved={saved}, "
+               "deleted={deleted}", category="app", atvs=len(atvs), bridges=len(bridges), **result)
+    return jsonify(dict(result, status="config_imported",
+                        apple_tvs=len(atvs), hue_bridges=len(bridges)))
+
+@app.route("/api/rooms/reload", methods=["POST"])
+def api_reload_rooms():
+    """Re-read rooms from the DB, e.g. after it was edited by another process."""
+    reload_room_index()
+    return jsonify({"status": "rooms_reloaded", "count": len(rooms_by_name)})
 
 @app.route("/api/rooms/<room_name>", methods=["DELETE"])
 def api_delete_room(room_name):
+    rinfo = get_room(room_name)
     rc = delete_room_db(room_name)
+    if rinfo is not None:
+        forget_room(room_name, rinfo)
     if rc > 0:
-        append_log(f"Room => deleted name='{room_name}'")
+        append_log("Room => deleted name='{room}'", category="room", room=room_name)
         return jsonify({"status": "room_deleted", "room_name": room_name})
     else:
         return jsonify({"error": "Room not found"}), 404
@@ -621,19 +2735,33 @@ def api_delete_room(room_name):
 tray_icon = None
 
 def launch_browser(_icon=None, _item=None):
+    import webbrowser
     webbrowser.open(f"http://{HOST}:{PORT}")
 
-def on_exit(_icon=None, _item=None):
-    """Stop the Flask app and close the tray."""
+def shutdown():
+    """Flush pending writes and stop background work."""
     append_log("Exiting RnR Automation...")
+    connected_writer.flush()
+    history_writer.flush()
     # Stop the event loop
     loop.stop()
-    # Stop the tray icon
+    # Don't wait for in-flight bridge calls
+    with bridge_executors_lock:
+        for ex in bridge_executors.values():
+            ex.shutdown(wait=False)
+    stop_light_streamer()
+    flush_logs()
+
+def on_exit(_icon=None, _item=None):
+    """Stop the Flask app and close the tray."""
+    shutdown()
     tray_icon.stop()
 
 def setup_tray_icon():
     global tray_icon
-    
+    import pystray
+    from PIL import Image, ImageDraw  # pystray requires Pillow
+
     # Try loading favicon.ico from the static folder
     try:
         icon_image = Image.open(ICON_PATH)
@@ -652,32 +2780,73 @@ def setup_tray_icon():
     
     tray_icon = pystray.Icon("ATV & Hue", icon_image, "ATV & Hue", menu)
     tray_icon.run()
+
 ###############################################################################
-# MAIN LAUNCH
+# HTTP SERVER
 ###############################################################################
-if __name__ == "__main__":
+def serve_http():
+    """Serve the Flask app until interrupted (blocking).
+
+    Route handlers run on the server's threads and only reach the event loop
+    through call_soon_threadsafe / run_coroutine_threadsafe, so any number of
+    server threads can share it.
+    """
+    if SERVER == "waitress":
+        try:
+            from waitress import create_server
+        except ImportError:
+            append_log("waitress not installed (pip install waitress), using the Flask dev server", "WARN")
+        else:
+            server = create_server(
+                app, host=HOST, port=PORT, threads=SERVER_THREADS,
+                connection_limit=SERVER_CONNECTION_LIMIT,
+                channel_timeout=SERVER_CHANNEL_TIMEOUT, channel_request_lookahead=1,
+                ident="RnR Automation")
+            append_log("Serving on http://{host}:{port} (waitress, {threads} threads)",
+                       host=HOST, port=PORT, threads=SERVER_THREADS)
+            server.run()
+            return
+    app.run(host=HOST, port=PORT, debug=False, threaded=True)
+
+def start_background():
+    """Create tables, start the saved Apple TV monitors and the event loop thread."""
     create_tables()
+    reload_room_index()
 
     # Start Apple TV monitors for any Apple TVs that are fully paired
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT atv_id FROM apple_tvs WHERE credentials<>''")
-    existing_tvs = c.fetchall()
-    conn.close()
+    with db_cursor() as c:
+        c.execute("SELECT atv_id FROM apple_tvs WHERE credentials<>''")
+        existing_tvs = c.fetchall()
 
     for (aid,) in existing_tvs:
-        loop.create_task(monitor_apple_tv(aid))
+        ensure_monitor(aid)
+
+    if LIGHT_REFRESH_SEC > 0:
+        loop.create_task(refresh_hue_inventory_forever())
 
     # Start the asyncio loop in a background thread
     t = threading.Thread(target=start_loop, args=(loop,), daemon=True)
     t.start()
 
-    # Start Flask in another thread so it won't block the tray icon
-    flask_thread = threading.Thread(
-        target=lambda: app.run(host=HOST, port=PORT, debug=False),
-        daemon=True
-    )
-    flask_thread.start()
+###############################################################################
+# MAIN LAUNCH
+###############################################################################
+if __name__ == "__main__":
+    start_background()
+
+    if HEADLESS:
+        # Serve on the main thread; SIGTERM (systemd, docker stop) exits like Ctrl+C
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            serve_http()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            shutdown()
+    else:
+        # Start Flask in another thread so it won't block the tray icon
+        flask_thread = threading.Thread(target=serve_http, daemon=True)
+        flask_thread.start()
 
-    # Finally, set up and show the tray icon (blocking call).
-    setup_tray_icon()
+        # Finally, set up and show the tray icon (blocking call).
+        setup_tray_icon()
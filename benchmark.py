@@ -0,0 +1,581 @@
+###############################################################################
+# benchmark.py
+###############################################################################
+# Load benchmark for app.py with simulated Apple TVs and Hue bridges.
+#
+#   python benchmark.py                      # defaults below
+#   python benchmark.py --tvs 50 --rooms 100 --lights 4 --bridges 2 \
+#       --bursts 20 --burst-size 5 --bridge-latency-ms 30 --bridge-rate 10
+#   python benchmark.py --json > run.json    # machine-readable, for comparing runs
+#   python benchmark.py --startup 5          # cold start of `app.py --headless`
+#
+# Apple TVs are stand-ins that push playstatus updates into
+# RnRAppleTVListener.playstatus_update on app's event loop, the way pyatv
+# does. Each Hue bridge is a local HTTP emulator with configurable latency
+# and a token-bucket rate limit (requests over the limit get the bridge's
+# 901 error back). With --stream, rooms use an entertainment area and the
+# app streams plain-UDP HueStream frames to a local receiver instead. The
+# app runs from a temporary directory, so the real config.json and databases
+# are never touched. --startup instead launches fresh app processes and times
+# the import of app and the first HTTP response.
+###############################################################################
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DESCRIPTION = "Load benchmark for app.py with simulated Apple TVs and Hue bridges."
+
+###############################################################################
+# HELPERS
+###############################################################################
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def latency_report(samples):
+    """{count, p50_ms, p95_ms, p99_ms, max_ms} for a list of seconds."""
+    out = {"count": len(samples)}
+    for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        v = percentile(samples, q)
+        out[name] = None if v is None else round(v * 1000, 2)
+    out["max_ms"] = round(max(samples) * 1000, 2) if samples else None
+    return out
+
+class TokenBucket:
+    """`rate` tokens per second, up to `burst`; rate <= 0 means unlimited."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+###############################################################################
+# HUE BRIDGE EMULATOR
+###############################################################################
+class HueEmulator:
+    """Minimal Hue v1 REST bridge: lights, light state, groups and group actions."""
+
+    def __init__(self, lights=50, latency_ms=0.0, rate=0.0, burst=None):
+        self.latency = latency_ms / 1000
+        self.bucket = TokenBucket(rate, burst or max(1, rate))
+        self.lock = threading.Lock()
+        self.lights = {str(i): {"on": False, "bri": 1} for i in range(1, lights + 1)}
+        self.groups = {}
+        self.counts = {}
+        self.connections = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="hue-emulator",
+                         daemon=True).start()
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def handle(self, method, path, body):
+        """Return the JSON reply for one request."""
+        parts = [p for p in path.split("/") if p][2:]     # drop "api", user
+        if not self.bucket.take():
+            self.count("rate_limited")
+            return [{"error": {"type": 901, "address": path,
+                               "description": "Internal error, 503"}}]
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if parts == ["lights"] and method == "GET":
+                self.counts["get_lights"] = self.counts.get("get_lights", 0) + 1
+                return {lid: {"name": f"Light {lid}", "type": "Extended color light",
+                              "state": dict(st, reachable=True)}
+                        for lid, st in self.lights.items()}
+            if len(parts) == 3 and parts[0] == "lights" and parts[2] == "state":
+                self.counts["light_state"] = self.counts.get("light_state", 0) + 1
+                if parts[1] not in self.lights:
+                    return [{"error": {"type": 3, "address": path,
+                                       "description": "resource not available"}}]
+                self.lights[parts[1]].update({k: v for k, v in body.items() if k in ("on", "bri")})
+                return [{"success": {f"/lights/{parts[1]}/state/{k}": v}} for k, v in body.items()]
+            if parts == ["groups"] and method == "POST":
+                self.counts["group_create"] = self.counts.get("group_create", 0) + 1
+                gid = str(len(self.groups) + 1)
+                self.groups[gid] = body
+                return [{"success": {"id": gid}}]
+            if len(parts) == 2 and parts[0] == "groups" and "stream" in body:
+                # Entertainment areas exist on the bridge already
+                self.counts["stream_toggle"] = self.counts.get("stream_toggle", 0) + 1
+                return [{"success": {f"/groups/{parts[1]}/stream/active": body["stream"]["active"]}}]
+            if len(parts) >= 2 and parts[0] == "groups":
+                kind = "group_action" if parts[2:] == ["action"] else f"group_{method.lower()}"
+                self.counts[kind] = self.counts.get(kind, 0) + 1
+                group = self.groups.get(parts[1])
+                if group is None:
+                    return [{"error": {"type": 3, "address": path,
+                                       "description": "resource not available"}}]
+                if method == "DELETE":
+                    del self.groups[parts[1]]
+                    return [{"success": f"/groups/{parts[1]} deleted"}]
+                if kind == "group_action":
+                    for lid in group.get("lights", []):
+                        if lid in self.lights:
+                            self.lights[lid].update(
+                                {k: v for k, v in body.items() if k in ("on", "bri")})
+                else:
+                    group.update(body)
+                return [{"success": {f"/groups/{parts[1]}/{k}": v}} for k, v in body.items()]
+            self.counts["other"] = self.counts.get("other", 0) + 1
+            return [{"success": {}}]
+
+    def _handler(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"       # keep-alive, like a real bridge
+            wbufsize = -1                       # headers + body in one write
+
+            def _reply(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(n) if n else b""
+                body = json.loads(raw) if raw else {}
+                emulator.connections.add(self.client_address)
+                out = json.dumps(emulator.handle(self.command, self.path, body)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _reply
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+###############################################################################
+# ENTERTAINMENT STREAM RECEIVER (UDP stand-in for the bridge's DTLS endpoint)
+###############################################################################
+class HueStreamReceiver:
+    """Decode HueStream v1 messages and keep per-light levels and counts."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.messages = 0
+        self.bad = 0
+        self.light_updates = 0
+        self.levels = {}        # light id => 0.0–1.0
+        self.first = self.last = None
+        threading.Thread(target=self._run, name="stream-receiver", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(2048)
+            except OSError:
+                return
+            if len(data) < 16 or data[:9] != b"HueStream" or (len(data) - 16) % 9:
+                self.bad += 1
+                continue
+            now = time.monotonic()
+            self.first = self.first or now
+            self.last = now
+            self.messages += 1
+            for off in range(16, len(data), 9):
+                _, lid, r, _, _ = struct.unpack_from(">BHHHH", data, off)
+                self.levels[lid] = r / 0xFFFF
+                self.light_updates += 1
+
+    def report(self):
+        span = (self.last - self.first) if self.first and self.last else 0
+        return {
+            "messages": self.messages,
+            "messages_per_sec": round(self.messages / span, 1) if span else None,
+            "light_updates": self.light_updates,
+            "lights": len(self.levels),
+            "malformed": self.bad,
+        }
+
+###############################################################################
+# APPLE TV PUSH SOURCE
+###############################################################################
+class FakePlaystate:
+    """The one attribute of pyatv's Playing that the listener reads."""
+
+    def __init__(self, device_state):
+        self.device_state = device_state
+
+def build_schedule(tvs, bursts, burst_size, burst_gap_ms, duration):
+    """[(offset_sec, atv_id, state)] sorted by time.
+
+    Each TV gets `bursts` bursts spread over `duration`; a burst is
+    `burst_size` alternating play/pause changes `burst_gap_ms` apart
+    (scrubbing, ad skips), always ending on a definite state.
+    """
+    events = []
+    for atv_id in tvs:
+        for _ in range(bursts):
+            start = random.uniform(0, duration)
+            final = random.choice(("playing", "paused", "stopped"))
+            for i in range(burst_size):
+                if i == burst_size - 1:
+                    state = final
+                else:
+                    state = "playing" if (burst_size - 1 - i) % 2 else "paused"
+                events.append((start + i * burst_gap_ms / 1000, atv_id, state))
+    events.sort()
+    return events
+
+###############################################################################
+# BENCHMARK
+###############################################################################
+def setup_app(args, workdir, receiver=None):
+    """Import app from a scratch directory configured for the run."""
+    conf = {
+        "settle_ms": args.settle_ms,
+        "hue_workers": args.hue_workers,
+        "light_refresh_sec": 0,
+        "log_buffer": 1000,
+    }
+    if receiver is not None:
+        conf.update(stream_transport="udp", stream_port=receiver.port,
+                    stream_fps=args.stream_fps)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(conf, f)
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import app
+    return app
+
+def populate(app, args, bridges):
+    """N Apple TVs, M rooms over them, K lights per room spread across bridges."""
+    tvs = [f"bench-atv-{i}" for i in range(args.tvs)]
+    with app.db_cursor():
+        app.save_hue_bridge_db(bridges[0].address, "bench")
+        for i, atv_id in enumerate(tvs):
+            app.save_apple_tv(atv_id, f"Bench TV {i}", f"10.0.0.{i % 250 + 1}", "creds")
+        for r in range(args.rooms):
+            bridge = bridges[r % len(bridges)]
+            first = (r // len(bridges)) * args.lights + 1
+            lights = [first + k for k in range(args.lights)]     # ints, as the UI sends
+            app.save_room_db(f"Bench Room {r}", tvs[r % len(tvs)], bridge.address, "bench",
+                             lights, 60, 30, 100, 0, 0, 0, "1" if args.stream else None)
+    app.reload_room_index()
+    return tvs
+
+def wait_idle(app, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with app.room_queues_lock:
+            busy = bool(app.room_pending or app.room_running)
+        if not busy:
+            return True
+        time.sleep(0.01)
+    return False
+
+def run_events(app, args, tvs):
+    """Replay the burst schedule through the push listener on app's loop."""
+    from pyatv.const import DeviceState
+    states = {"playing": DeviceState.Playing, "paused": DeviceState.Paused,
+              "stopped": DeviceState.Stopped}
+    listeners = {atv_id: app.RnRAppleTVListener(atv_id) for atv_id in tvs}
+    schedule = build_schedule(tvs, args.bursts, args.burst_size, args.burst_gap_ms,
+                              args.duration)
+
+    applied = []
+    record_light_state = app.record_light_state
+
+    def observe(room_name, atv_id, state, latency):
+        applied.append(latency)
+        record_light_state(room_name, atv_id, state, latency)
+    app.record_light_state = observe
+
+    dispatch = []
+
+    def push(atv_id, state):
+        t = time.perf_counter()
+        listeners[atv_id].playstatus_update(None, FakePlaystate(states[state]))
+        dispatch.append(time.perf_counter() - t)
+
+    start = time.monotonic()
+    for offset, atv_id, state in schedule:
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        app.loop.call_soon_threadsafe(push, atv_id, state)
+    sent = time.monotonic() - start
+    # Let the loop catch up with the pushes still queued on it
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), app.loop).result(args.timeout)
+    idle = wait_idle(app, args.timeout)
+    elapsed = time.monotonic() - start
+    app.record_light_state = record_light_state
+    return {
+        "events": len(schedule),
+        "send_sec": round(sent, 3),
+        "drain_sec": round(elapsed, 3),
+        "drained": idle,
+        "events_per_sec": round(len(schedule) / sent, 1) if sent else None,
+        "room_updates_sent": len(applied),
+        "room_updates_per_sec": round(len(applied) / elapsed, 1) if elapsed else None,
+        "dispatch_latency": latency_report(dispatch),
+        "event_to_light_latency": latency_report(applied),
+    }
+
+API_PATHS = ("/api/rooms", "/api/apple_tvs", "/api/hue/status", "/api/status",
+             "/api/logs?since=0", "/api/metrics")
+
+def run_api(app, args):
+    """Hammer the polled read APIs from `api_clients` threads for `api_sec` seconds."""
+    samples = {path: [] for path in API_PATHS}
+    errors = []
+    stop = time.monotonic() + args.api_sec
+
+    def client(n):
+        tc = app.app.test_client()
+        paths = API_PATHS[n % len(API_PATHS):] + API_PATHS[:n % len(API_PATHS)]
+        i = 0
+        while time.monotonic() < stop:
+            path = paths[i % len(paths)]
+            i += 1
+            t = time.perf_counter()
+            resp = tc.get(path)
+            resp.get_data()
+            samples[path].append(time.perf_counter() - t)
+            if resp.status_code >= 400:
+                errors.append((path, resp.status_code))
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.api_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = sum(len(v) for v in samples.values())
+    return {
+        "requests": total,
+        "requests_per_sec": round(total / args.api_sec, 1) if args.api_sec else None,
+        "errors": len(errors),
+        "endpoints": {path: latency_report(v) for path, v in samples.items()},
+    }
+
+# Runs in a child process from the scratch directory; reports on stderr since
+# the app logs to stdout
+IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+t = time.perf_counter()
+import app
+out = {"import_sec": time.perf_counter() - t, "modules": len(sys.modules),
+       "loaded": [m for m in ("pyatv", "phue", "pystray", "PIL", "webbrowser")
+                  if m in sys.modules]}
+# What the first Apple TV connection pays later
+t = time.perf_counter()
+try:
+    import pyatv
+    out["pyatv_sec"] = time.perf_counter() - t
+except ImportError:
+    out["pyatv_sec"] = None
+sys.stderr.write(json.dumps(out) + "\\n")
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_http(port, timeout):
+    """Poll GET /api/rooms until it answers 200; True if it did in time."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/rooms")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.01)
+    return False
+
+def run_startup(args):
+    """Cold-start `app.py --headless` args.startup times in fresh scratch dirs."""
+    imports, pyatv_imports, ready = [], [], []
+    probe = None
+    for _ in range(args.startup):
+        workdir = tempfile.mkdtemp(prefix="rnr-bench-")
+        port = free_port()
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump({"port": port, "light_refresh_sec": 0}, f)
+
+        res = subprocess.run([sys.executable, "-c", IMPORT_PROBE, HERE], cwd=workdir,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        probe = json.loads(res.stderr.strip().splitlines()[-1])
+        imports.append(probe["import_sec"])
+        if probe["pyatv_sec"] is not None:
+            pyatv_imports.append(probe["pyatv_sec"])
+
+        t = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(HERE, "app.py"), "--headless"],
+                                cwd=workdir, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            if wait_http(port, args.timeout):
+                ready.append(time.perf_counter() - t)
+        finally:
+            proc.terminate()
+            proc.wait(10)
+    return {
+        "runs": args.startup,
+        "failed": args.startup - len(ready),
+        "import_app": latency_report(imports),
+        "first_response": latency_report(ready),
+        "pyatv_import": latency_report(pyatv_imports),
+        "modules_after_import": probe["modules"],
+        "loaded_after_import": probe["loaded"],
+    }
+
+def print_startup_report(report):
+    print(f"Cold starts: {report['runs']} ({report['failed']} never answered)")
+    for name in ("import_app", "first_response", "pyatv_import"):
+        r = report[name]
+        print(f"  {name:<16} n={r['count']:<4} p50={r['p50_ms']}ms max={r['max_ms']}ms")
+    print(f"After `import app`: {report['modules_after_import']} modules, "
+          f"device/tray libraries loaded: {', '.join(report['loaded_after_import']) or 'none'}")
+
+def print_report(report):
+    cfg = report["config"]
+    print(f"Apple TVs={cfg['tvs']} rooms={cfg['rooms']} lights/room={cfg['lights']} "
+          f"bridges={cfg['bridges']} settle={cfg['settle_ms']}ms "
+          f"bridge latency={cfg['bridge_latency_ms']}ms rate={cfg['bridge_rate'] or 'unlimited'}/s")
+    ev = report["events"]
+    print(f"\nPlay-state events: {ev['events']} in {ev['send_sec']}s "
+          f"({ev['events_per_sec']}/s), drained in {ev['drain_sec']}s"
+          + ("" if ev["drained"] else "  ** TIMED OUT **"))
+    print(f"Room updates sent: {ev['room_updates_sent']} ({ev['room_updates_per_sec']}/s)")
+    for name in ("dispatch_latency", "event_to_light_latency"):
+        r = ev[name]
+        print(f"  {name:<24} n={r['count']:<6} p50={r['p50_ms']}ms "
+              f"p95={r['p95_ms']}ms p99={r['p99_ms']}ms max={r['max_ms']}ms")
+    print("\nBridge requests:")
+    for addr, counts in report["bridges"].items():
+        print(f"  {addr}: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    if "stream" in report:
+        st = report["stream"]
+        print(f"\nStream: {st['messages']} messages ({st['messages_per_sec']}/s), "
+              f"{st['light_updates']} light updates for {st['lights']} lights, "
+              f"{st['malformed']} malformed")
+    if "api" in report:
+        api = report["api"]
+        print(f"\nAPI: {api['requests']} requests ({api['requests_per_sec']}/s), "
+              f"{api['errors']} error(s)")
+        for path, r in api["endpoints"].items():
+            print(f"  {path:<20} n={r['count']:<6} p50={r['p50_ms']}ms "
+                  f"p95={r['p95_ms']}ms p99={r['p99_ms']}ms")
+
+def main():
+    ap = argparse.ArgumentParser(description=DESCRIPTION)
+    ap.add_argument("--tvs", type=int, default=10, help="simulated Apple TVs")
+    ap.add_argument("--rooms", type=int, default=20, help="rooms (assigned to TVs round-robin)")
+    ap.add_argument("--lights", type=int, default=4, help="lights per room")
+    ap.add_argument("--bridges", type=int, default=1, help="emulated Hue bridges")
+    ap.add_argument("--bursts", type=int, default=10, help="state-change bursts per TV")
+    ap.add_argument("--burst-size", type=int, default=4, help="state changes per burst")
+    ap.add_argument("--burst-gap-ms", type=float, default=50, help="gap inside a burst")
+    ap.add_argument("--duration", type=float, default=5, help="seconds to spread bursts over")
+    ap.add_argument("--settle-ms", type=float, default=250, help="app settle_ms")
+    ap.add_argument("--hue-workers", type=int, default=4, help="app hue_workers")
+    ap.add_argument("--bridge-latency-ms", type=float, default=20, help="per request")
+    ap.add_argument("--bridge-rate", type=float, default=0,
+                    help="requests/s per bridge before 901 errors (0 = unlimited)")
+    ap.add_argument("--bridge-burst", type=int, default=None, help="token bucket size")
+    ap.add_argument("--stream", action="store_true",
+                    help="use entertainment streaming (UDP stand-in) instead of REST")
+    ap.add_argument("--stream-fps", type=float, default=25, help="app stream_fps")
+    ap.add_argument("--api-clients", type=int, default=4, help="concurrent API pollers")
+    ap.add_argument("--api-sec", type=float, default=3, help="API phase length (0 = skip)")
+    ap.add_argument("--timeout", type=float, default=60, help="max wait for queues to drain")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    ap.add_argument("--startup", type=int, default=0, metavar="N",
+                    help="only time N cold starts of `app.py --headless`")
+    args = ap.parse_args()
+    if args.startup > 0:
+        report = run_startup(args)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_startup_report(report)
+        return
+    random.seed(args.seed)
+    # The app logs every event to stdout; keep the report readable
+    report_out, sys.stdout = sys.stdout, open(os.devnull, "w")
+    logging.getLogger("phue").setLevel(logging.CRITICAL)
+
+    bridges = [HueEmulator(lights=max(1, -(-args.rooms // args.bridges)) * args.lights,
+                           latency_ms=args.bridge_latency_ms, rate=args.bridge_rate,
+                           burst=args.bridge_burst)
+               for _ in range(args.bridges)]
+    workdir = tempfile.mkdtemp(prefix="rnr-bench-")
+    receiver = HueStreamReceiver() if args.stream else None
+    app = setup_app(args, workdir, receiver)
+    app.create_tables()
+    tvs = populate(app, args, bridges)
+    threading.Thread(target=app.start_loop, args=(app.loop,), daemon=True).start()
+
+    report = {"config": {k: getattr(args, k) for k in (
+        "tvs", "rooms", "lights", "bridges", "bursts", "burst_size", "settle_ms",
+        "hue_workers", "bridge_latency_ms", "bridge_rate", "stream")}}
+    report["events"] = run_events(app, args, tvs)
+    report["bridges"] = {b.address: dict(b.counts, connections=len(b.connections))
+                         for b in bridges}
+    if receiver is not None:
+        report["stream"] = receiver.report()
+    if args.api_sec > 0:
+        report["api"] = run_api(app, args)
+
+    sys.stdout = report_out
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    app.loop.call_soon_threadsafe(app.loop.stop)
+    for b in bridges:
+        b.close()
+
+if __name__ == "__main__":
+    main()